@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Search regular expressions anchored at the start or at the end of the
+string, like greeting_regexp and goodbye_regexp, without scanning the
+whole string.
+
+A match of a pattern starting with ^ can only start at offset 0, and a
+match of a pattern ending with $ can only start within the maximal width
+of the pattern (plus one for a trailing line break) before the end. Only
+this window is searched, but as part of the whole string, so that ^, \\b
+and lookbehind assertions see the same context. The results are always
+the same as the ones of re.search() and re.sub().
+
+"""
+
+import re
+import sre_parse
+import sre_constants as c
+
+_at_start = (c.AT_BEGINNING, c.AT_BEGINNING_STRING)
+_at_end = (c.AT_END, c.AT_END_STRING)
+
+# width of these is not known by getwidth()
+_unknown_width = (c.GROUPREF, c.GROUPREF_EXISTS)
+
+def _contains(pattern, ops):
+    """Return True if parsed pattern contains any of ops."""
+    if isinstance(pattern, sre_parse.SubPattern):
+        return any(op in ops or _contains(av, ops) for op, av in pattern.data)
+    if isinstance(pattern, (tuple, list)):
+        return any(_contains(p, ops) for p in pattern)
+    return False
+
+class AnchoredRegexp(object):
+    """Compiled regular expression, with search() and sub_first() limited to
+    the start or the end of the string if the pattern is anchored there.
+
+    Patterns which are anchored at neither end, or at the end but can have
+    matches of unlimited length, are searched in the whole string.
+
+    """
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.regexp = re.compile(pattern, flags)
+        self.anchor = None
+        # maximal number of characters a match can start before the end
+        self.window = None
+        parsed = sre_parse.parse(pattern, flags)
+        if not parsed.data or parsed.pattern.flags & sre_parse.SRE_FLAG_MULTILINE:
+            return
+        first, last = parsed.data[0], parsed.data[-1]
+        if first[0] == c.AT and first[1] in _at_start:
+            self.anchor = 'start'
+        elif last[0] == c.AT and last[1] in _at_end and not _contains(parsed, _unknown_width):
+            width = parsed.getwidth()[1]
+            if width < c.MAXREPEAT:
+                self.anchor = 'end'
+                # $ also matches before a line break at the end
+                self.window = width + 1 if last[1] == c.AT_END else width
+
+    def search(self, string):
+        """Return the same match as self.regexp.search(string)."""
+        if self.anchor == 'start':
+            return self.regexp.match(string)
+        if self.anchor == 'end':
+            return self.regexp.search(string, max(0, len(string) - self.window))
+        return self.regexp.search(string)
+
+    def sub_first(self, repl, string, match=None):
+        """Return the same as self.regexp.sub(repl, string, 1), repl has to
+        be a string without group references. If the match has already been
+        found by search(string), it can be given.
+
+        """
+        if match is None:
+            match = self.search(string)
+        if match is None:
+            return string
+        return string[:match.start()] + repl + string[match.end():]
@@ -13,3 +13,60 @@ def filter_any(pred, seq):
         if pred(x):
             return True
     return False
+
+class LRUCache(object):
+    """Mapping of at most max_size items, the least recently used item is
+    removed to make room for a new one. Counts hits and misses of get().
+
+    The items are kept in a circular doubly linked list of links
+    [prev, next, key, value], the most recently used one last, whose
+    links are found by key in a dictionary.
+
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._links = {}
+        self._root = [None, None, None, None]
+        self._root[0] = self._root[1] = self._root
+
+    def _move_to_end(self, link):
+        root = self._root
+        link[0][1] = link[1]
+        link[1][0] = link[0]
+        link[0] = root[0]
+        link[1] = root
+        root[0][1] = root[0] = link
+
+    def get(self, key, default=None):
+        link = self._links.get(key)
+        if link is None:
+            self.misses += 1
+            return default
+        self._move_to_end(link)
+        self.hits += 1
+        return link[3]
+
+    def __setitem__(self, key, value):
+        link = self._links.get(key)
+        if link is not None:
+            link[3] = value
+            self._move_to_end(link)
+            return
+        root = self._root
+        link = [root[0], root, key, value]
+        root[0][1] = root[0] = self._links[key] = link
+        if len(self._links) > self.max_size:
+            oldest = root[1]
+            root[1] = oldest[1]
+            oldest[1][0] = root
+            del self._links[oldest[2]]
+
+    def __len__(self):
+        return len(self._links)
+
+    def hit_rate(self):
+        """Return percentage of get() calls which found the key."""
+        n = self.hits + self.misses
+        return 100.0 * self.hits / n if n else 0.0
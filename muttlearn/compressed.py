@@ -0,0 +1,459 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Random access to gzip and bz2 compressed mailboxes."""
+
+import re
+import bisect
+import collections
+import binascii
+import zlib
+import bz2
+import mmap
+import tempfile
+
+# size of compressed data which is decompressed at once
+chunk_size = 1 << 18
+
+# minimum distance of checkpoints in the decompressed data
+checkpoint_interval = 1 << 20
+
+# minimum distance of copies of the gzip decompressor state, which are
+# kept in memory as additional checkpoints (about 40 KB each)
+resume_interval = 1 << 23
+
+# number of processes for decompressing, see decompress_parallel()
+jobs = 1
+
+# minimum size of compressed data which is decompressed by one process
+segment_size = 1 << 20
+
+def compression(path):
+    """Return 'gz', 'bz2' or None, based on the file name."""
+    m = re.match(r'.*\.(gz|bz2)$', path)
+    return m.group(1) if m else None
+
+def _new_decompressor(kind):
+    if kind == 'gz':
+        # decode gzip header and trailer
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    return bz2.BZ2Decompressor()
+
+class Decompressor(object):
+    """Sequential decompression of a gzip or bz2 file, which may consist of
+    multiple members (concatenated gzip files or bz2 streams).
+
+    Decompression starts at the compressed offset cpos, which has to be the
+    start of a member, and which corresponds to the decompressed offset
+    upos. The starts of all members passed are collected in members, every
+    one of them can serve as a checkpoint to restart decompression.
+
+    Within gzip members, a copy of the decompressor is saved in states
+    every resume_interval decompressed bytes, as (cpos, upos, state).
+    Decompression can be resumed there by passing state.
+
+    """
+    def __init__(self, f, kind, cpos=0, upos=0, state=None):
+        self.f = f
+        self.kind = kind
+        self.cpos = cpos
+        self.upos = upos
+        self.states = []
+        self._last_state = upos
+        if state is None:
+            self.members = [(cpos, upos)]
+            self._dec = _new_decompressor(kind)
+            self._n_members = 1
+        else:
+            self.members = []
+            dec, self._n_members = state
+            self._dec = dec.copy()
+        self._new_member = False
+        self._eof = False
+
+    def _feed(self, data):
+        out = []
+        while data:
+            try:
+                piece = self._dec.decompress(data)
+            except EOFError:
+                # bz2 stream ended exactly at the end of the last chunk
+                piece, unused = '', data
+            except (zlib.error, IOError):
+                # ignore trailing garbage (e.g. zero padding) after the
+                # first member, like gzip(1) does
+                if self._new_member and self._n_members > 1:
+                    self._eof = True
+                    break
+                raise
+            else:
+                unused = self._dec.unused_data
+                if self._new_member:
+                    self.members.append((self.cpos, self.upos))
+                    self._new_member = False
+            out.append(piece)
+            self.cpos += len(data) - len(unused)
+            self.upos += len(piece)
+            if not unused:
+                break
+            self._dec = _new_decompressor(self.kind)
+            self._n_members += 1
+            self._new_member = True
+            data = unused
+        # all data has been consumed, bz2 decompressors can not be copied
+        if self.kind == 'gz' and not self._eof and \
+                self.upos >= self._last_state + resume_interval:
+            self.states.append((self.cpos, self.upos, (self._dec.copy(), self._n_members)))
+            self._last_state = self.upos
+        return ''.join(out)
+
+    def decompress_chunk(self):
+        """Return next piece of decompressed data, '' at the end."""
+        while not self._eof:
+            self.f.seek(self.cpos)
+            data = self.f.read(chunk_size)
+            if not data:
+                break
+            out = self._feed(data)
+            if out:
+                return out
+        return ''
+
+class DecompressedFile(object):
+    """Random access to the decompressed content of a gzip or bz2 file.
+
+    GzipFile.seek() and BZ2File.seek() decompress from the start of the
+    file whenever they seek backwards. Here reads continue the
+    decompression of the previous read, or restart it at the nearest
+    checkpoint, so reading messages in order costs O(message size).
+
+    Checkpoints are the starts of gzip members and bz2 streams, which can
+    be saved by get_state() for the next run, and, for gzip files only,
+    the decompressor states of Decompressor, which are kept in memory
+    while the file is open. So random access costs O(resume_interval +
+    message size) in gzip files once the file has been read up to the
+    message, but in a bz2 file which consists of a single stream
+    decompression always restarts at its start.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        self.kind = compression(path)
+        self._file = open(path, 'rb')
+        # (compressed offset, decompressed offset) of restart points
+        self.checkpoints = [(0, 0)]
+        # (decompressed offset, compressed offset, state) of restart
+        # points within gzip members, see Decompressor
+        self._states = []
+        # size of decompressed data, if known
+        self.size = None
+        self._map = None
+        self._cursor = None
+        self._buf = ''
+        self._buf_pos = 0
+
+    def close(self):
+        if self._map:
+            self._map.close()
+        self._map = None
+        self._cursor = None
+        self._file.close()
+
+    def get_state(self):
+        return {
+            'checkpoints': self.checkpoints,
+            'size': self.size,
+        }
+
+    def restore(self, state):
+        """Restore checkpoints of get_state(), the file must not have changed."""
+        if state:
+            self.checkpoints = list(state['checkpoints'])
+            self.size = state['size']
+
+    def _add_checkpoints(self, members):
+        for cpos, upos in members:
+            if upos >= self.checkpoints[-1][1] + checkpoint_interval:
+                self.checkpoints.append((cpos, upos))
+        del members[:]
+
+    def _add_states(self, states):
+        for cpos, upos, state in states:
+            if not self._states or upos >= self._states[-1][0] + resume_interval:
+                self._states.append((upos, cpos, state))
+        del states[:]
+
+    def _restart_point(self, pos):
+        """Return (cpos, upos, state) of the nearest restart point before
+        decompressed offset pos, state is None for checkpoints.
+
+        """
+        i = bisect.bisect_right([c[1] for c in self.checkpoints], pos) - 1
+        cpos, upos = self.checkpoints[i]
+        i = bisect.bisect_right([s[0] for s in self._states], pos) - 1
+        if i >= 0 and self._states[i][0] > upos:
+            upos, cpos, state = self._states[i]
+            return cpos, upos, state
+        return cpos, upos, None
+
+    def read(self, start, stop):
+        """Return decompressed data from offset start to stop."""
+        if self._map is not None:
+            return self._map[start:stop]
+        cpos, upos, state = self._restart_point(start)
+        # restart if reading backwards, or to skip ahead
+        if self._cursor is None or start < self._buf_pos or upos > self._cursor.upos:
+            self._cursor = Decompressor(self._file, self.kind, cpos, upos, state)
+            self._buf, self._buf_pos = '', upos
+        pieces = []
+        pos = start
+        while pos < stop:
+            end = self._buf_pos + len(self._buf)
+            if pos < end:
+                piece = self._buf[pos-self._buf_pos:stop-self._buf_pos]
+                pieces.append(piece)
+                pos += len(piece)
+                continue
+            chunk = self._cursor.decompress_chunk()
+            if not chunk:
+                break
+            self._buf, self._buf_pos = chunk, end
+        self._add_checkpoints(self._cursor.members)
+        self._add_states(self._cursor.states)
+        return ''.join(pieces)
+
+    def _decompress_to(self, tmp):
+        dec = Decompressor(self._file, self.kind)
+        while True:
+            chunk = dec.decompress_chunk()
+            if not chunk:
+                break
+            tmp.write(chunk)
+            self._add_checkpoints(dec.members)
+            # the memory map is used for random access
+            del dec.states[:]
+        return dec.upos
+
+    def _decompress_parallel_to(self, tmp):
+        """Like _decompress_to(), but decompress segments of the file in
+        jobs processes. Return None if the segments turned out to be
+        invalid.
+
+        """
+        self._file.seek(0, 2)
+        if not self._file.tell():
+            return 0
+        cmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            segments = _find_segments(cmap, self.kind)
+            if len(segments) < 2:
+                return self._decompress_to(tmp)
+            upos = 0
+            checkpoints = []
+            for (cpos, is_member), data in decompress_parallel(cmap, segments):
+                if data is None:
+                    return None
+                if is_member:
+                    checkpoints.append((cpos, upos))
+                tmp.write(data)
+                upos += len(data)
+        finally:
+            cmap.close()
+        self._add_checkpoints(checkpoints)
+        return upos
+
+    def mmap(self):
+        """Decompress the whole file into an anonymous temporary file and
+        return a read-only memory map of it.
+
+        """
+        if self._map is None:
+            tmp = tempfile.TemporaryFile(prefix='muttlearn')
+            try:
+                size = None
+                if jobs > 1:
+                    size = self._decompress_parallel_to(tmp)
+                    if size is None:
+                        # fall back to sequential decompression
+                        tmp.seek(0)
+                        tmp.truncate()
+                if size is None:
+                    size = self._decompress_to(tmp)
+                tmp.flush()
+                self.size = size
+                # empty files can not be mapped
+                if self.size:
+                    self._map = mmap.mmap(tmp.fileno(), 0, access=mmap.ACCESS_READ)
+                else:
+                    self._map = ''
+            finally:
+                tmp.close()
+            self._cursor = None
+            self._buf = ''
+        return self._map
+
+_gz_magic = '\x1f\x8b\x08'
+_bz2_block_magic = 0x314159265359
+_bz2_eos_magic = 0x177245385090
+_re_bz2_stream = re.compile(r'BZh[1-9](?=1AY&SY|\x17rE8P\x90)')
+
+def _find_bits(buf, pattern, nbits=48):
+    """Return sorted bit offsets of all occurrences of the nbits long
+    integer pattern in buf, which do not have to be byte aligned.
+
+    """
+    found = []
+    for r in xrange(8):
+        # pattern shifted by r bits, stored in whole bytes
+        nbytes = (r + nbits + 7) // 8
+        shifted = pattern << (nbytes * 8 - nbits - r)
+        pbytes = binascii.unhexlify('%0*x' % (nbytes * 2, shifted))
+        head_mask = 0xff >> r
+        tail_bits = (r + nbits) % 8
+        tail_mask = (0xff00 >> tail_bits) & 0xff if tail_bits else 0xff
+        # search for the bytes which are completely covered by the pattern
+        first = 1 if r else 0
+        last = nbytes - 1 if tail_bits else nbytes
+        middle = pbytes[first:last]
+        i = buf.find(middle)
+        while i >= 0:
+            k = i - first
+            if k >= 0 and k + nbytes <= len(buf) and \
+                    ord(buf[k]) & head_mask == ord(pbytes[0]) & head_mask and \
+                    ord(buf[k+nbytes-1]) & tail_mask == ord(pbytes[-1]) & tail_mask:
+                found.append(k * 8 + r)
+            i = buf.find(middle, i + 1)
+    found.sort()
+    return found
+
+def _get_bits(buf, start, stop):
+    """Return bits start to stop of buf as integer."""
+    data = buf[start//8:(stop+7)//8]
+    value = int(binascii.hexlify(data), 16) if data else 0
+    return (value >> (len(data) * 8 - (stop - start//8*8))) & ((1 << (stop - start)) - 1)
+
+def _find_segments(buf, kind):
+    """Split compressed buf into segments which can be decompressed
+    independently. Return list of (cpos, is_member, task) tuples, where
+    cpos is the compressed offset of the segment start, is_member tells if
+    it is a checkpoint for Decompressor, and task is (kind, start, stop,
+    ...), the segment being buf[start:stop].
+
+    gzip files are split at member boundaries. bz2 files are split at
+    stream boundaries, and the blocks of a stream, which start at
+    arbitrary bit offsets, are cut out and wrapped into streams of their
+    own. The boundaries are found by searching for magic numbers, so they
+    might be wrong; this is detected by the decompression.
+
+    """
+    segments = []
+    if kind == 'gz':
+        i = 0
+        while i >= 0:
+            j = buf.find(_gz_magic, i + segment_size)
+            segments.append((i, True, ('gz', i, j if j >= 0 else len(buf))))
+            i = j
+        return segments
+    streams = [m.start() for m in _re_bz2_stream.finditer(buf)]
+    if not streams or streams[0] != 0:
+        return [(0, True, ('bz2', 0, len(buf)))]
+    markers = [(b, True) for b in _find_bits(buf, _bz2_block_magic)]
+    markers.extend((b, False) for b in _find_bits(buf, _bz2_eos_magic))
+    markers.sort()
+    offsets = [b for b, is_block in markers]
+    streams.append(len(buf))
+    for s, next_s in zip(streams, streams[1:]):
+        stream_markers = markers[bisect.bisect_left(offsets, s*8):bisect.bisect_left(offsets, next_s*8)]
+        eos = [b for b, is_block in stream_markers if not is_block]
+        if not eos:
+            return [(0, True, ('bz2', 0, len(buf)))]
+        blocks = [b for b, is_block in stream_markers if is_block and b < eos[0]]
+        is_member = True
+        first = 0
+        while first < len(blocks):
+            # group blocks to segments, combining their CRCs like bzip2
+            crc = 0
+            last = first
+            while True:
+                block_crc = _get_bits(buf, blocks[last] + 48, blocks[last] + 80)
+                crc = ((crc << 1) | (crc >> 31)) & 0xffffffff ^ block_crc
+                last += 1
+                end = blocks[last] if last < len(blocks) else eos[0]
+                if end - blocks[first] >= segment_size * 8 or last == len(blocks):
+                    break
+            segments.append((s if is_member else blocks[first] // 8, is_member,
+                             ('bz2-blocks', blocks[first] // 8, (end + 7) // 8,
+                              blocks[first] % 8, end - blocks[first]//8*8, crc)))
+            is_member = False
+            first = last
+    return segments
+
+def _decompress_segment(task):
+    """Decompress a segment found by _find_segments(), with the compressed
+    data instead of its offsets. Return None if it is invalid. Called in
+    worker processes.
+
+    """
+    kind, data = task[:2]
+    if kind == 'bz2-blocks':
+        start, stop, crc = task[2:]
+        nbits = stop - start
+        value = _get_bits(data, start, stop)
+        # append end of stream marker, combined CRC and padding
+        value = (((value << 48) | _bz2_eos_magic) << 32) | crc
+        nbits += 80
+        pad = -nbits % 8
+        value <<= pad
+        nbits += pad
+        data = 'BZh9' + binascii.unhexlify('%0*x' % (nbits // 4, value))
+        kind = 'bz2'
+    out = []
+    dec = _new_decompressor(kind)
+    try:
+        while data:
+            out.append(dec.decompress(data))
+            data = dec.unused_data
+            if data:
+                dec = _new_decompressor(kind)
+        # the last member has to be complete
+        if kind == 'gz':
+            dec.decompress('\0')
+            if dec.unused_data != '\0':
+                return None
+        else:
+            try:
+                dec.decompress('\0')
+            except EOFError:
+                pass
+            else:
+                return None
+    except (zlib.error, IOError):
+        return None
+    return ''.join(out)
+
+def decompress_parallel(buf, segments):
+    """Decompress segments of buf in jobs processes, generate
+    ((cpos, is_member), data) in order, data is None for invalid segments.
+
+    """
+    # delayed import, not needed if decompressing sequentially
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        pending = collections.deque()
+        for cpos, is_member, task in segments:
+            task = (task[0], buf[task[1]:task[2]]) + task[3:]
+            pending.append(((cpos, is_member), pool.apply_async(_decompress_segment, (task,))))
+            if len(pending) > 2 * jobs:
+                pos, result = pending.popleft()
+                yield pos, result.get()
+        while pending:
+            pos, result = pending.popleft()
+            yield pos, result.get()
+    finally:
+        pool.terminate()
@@ -79,6 +79,7 @@ defaults = {
     'greeting_random_percent':   25,
     'greeting_random_max': 5,
     'known_languages':       u'*',
+    'language_per_recipient': False,
     'gen_locale':            True,
     'activate_spell_check':  True,
     'gen_goodbye':           True,
@@ -86,6 +87,12 @@ defaults = {
     'goodbye_random_max': 5,
     'gen_send_charset':      True,
     'max_age':               -1,
+    'newest_first':          False,
+    'max_age_cutoff':        100,
+    'max_body_size':         0,
+    'readahead':             0,
+    'pipeline':              False,
+    'max_memory':            0,
     'crypt_order':           u'pgp_both:smime_both:smime_sign:pgp_sign',
     'gen_crypt':             False,
     'weight_formula':        u'1.0 / math.sqrt(age + 1)',
@@ -104,11 +111,27 @@ variables_used_in_scan = set([
     'greeting_regexp',
     'goodbye_regexp',
     'personalize_mailinglists',
+    'max_body_size',
 ])
 
 members_used_in_scan = set([
 ])
 
+# variables and members of the header filters, see scan.Message.is_wanted(),
+# and of what else changes the contribution of a cached message
+variables_used_in_filters = set([
+    'skip_multiple_recipients',
+    'exclude_mails_to_me',
+    'only_include_mails_from_me',
+    'max_age',
+    'known_languages',
+    'language_per_recipient',
+])
+members_used_in_filters = set([
+    'alternates',
+    'unalternates',
+])
+
 def default_editor_type(editor):
     """Guess editor type based on full editor command (using basename)."""
     editor_name = os.path.basename(editor.split()[0])
@@ -150,20 +173,37 @@ def init(conf_path=None, mutt_conf_path=None, read_muttrc=True):
         options['only_include_mails_from_me'] = False
 
 cache_conf_path = os.path.expanduser('~/.muttlearn/cache_config')
-cache_version = 2
+cache_version = 4
+# oldest cache version which can be converted by main.migrate_cache()
+cache_migrate_version = 2
+
+def db_version():
+    """Return version of the cache, or None if there is none."""
+    if not os.path.exists(cache_conf_path):
+        return None
+    d = shelve.open(cache_conf_path, flag='r', protocol=2)
+    version = d['version']
+    d.close()
+    return version
 
 def db_needs_rebuilding():
     """Check if configuration values that affect scanning process have changed."""
     if not os.path.exists(cache_conf_path):
         return True
     d = shelve.open(cache_conf_path, flag='r', protocol=2)
-    if cache_version > d['version']:
-        log.debug('cache too old (version %d > %d), need to rebuild', cache_version, d['version'])
-        return True
-    vardict = dict([(k, rc.variables[k]) for k in variables_used_in_scan])
-    if d['variables'] != vardict:
-        log.debug('some important variables changed, need to rebuild cache')
+    if cache_migrate_version > d['version']:
+        log.debug('cache too old (version %d > %d), need to rebuild', cache_migrate_version, d['version'])
         return True
+    for k in variables_used_in_scan:
+        if k in d['variables']:
+            value = d['variables'][k]
+        else:
+            # variable is newer than the cache, which has been built
+            # as with its default value
+            value = defaults[k]
+        if value != rc.variables[k]:
+            log.debug('some important variables changed, need to rebuild cache')
+            return True
     for k in members_used_in_scan:
         if d[k] != getattr(rc, k):
             log.debug('some important commands changed, need to rebuild cache')
@@ -233,9 +273,9 @@ set gen_fcc = yes
 # Can only be true if $sig_dashes is set and $sig_on_top is unset.
 set gen_sig = yes
 
-# If python package guess_language is installed, the most frequently used
-# language can be guessed. Since this is sometimes faulty, this
-# colon-delimited list specifies all 'valid' languages to consider.
+# The most frequently used language is guessed. Since this is sometimes
+# faulty, this colon-delimited list specifies all 'valid' languages to
+# consider, only these are compared when guessing.
 # A single star '*' means all languages.
 set known_languages = en:de
 
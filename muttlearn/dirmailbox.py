@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Fast read-only access to Maildir and MH mailboxes."""
+
+import os
+import stat
+import time
+import email
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+import log
+
+def list_files(path):
+    """Generate (name, inode, size, mtime) of all files in directory path,
+    with one stat per file and without opening any of them.
+
+    """
+    if scandir is not None:
+        for entry in scandir(path):
+            if not entry.is_dir():
+                st = entry.stat()
+                yield entry.name, st.st_ino, st.st_size, st.st_mtime
+    else:
+        for name in os.listdir(path):
+            st = os.stat(os.path.join(path, name))
+            if not stat.S_ISDIR(st.st_mode):
+                yield name, st.st_ino, st.st_size, st.st_mtime
+
+class DirMailbox(object):
+    """A read-only Maildir or MH mailbox.
+
+    Inode, size and mtime of all messages are known from listing the
+    directories, so no message file has to be opened to check whether it
+    has changed. Directories whose mtime did not change since the previous
+    run (see get_state()) are not even listed. This relies on message files
+    not being modified in place, which Maildir guarantees and MH clients
+    usually respect.
+
+    """
+    colon = ':'
+
+    def __init__(self, path, type='Maildir'):
+        self.path = path
+        self.type = type
+        if type == 'Maildir':
+            # same order as mailbox.Maildir, to iterate in the same order
+            self._subdirs = ['new', 'cur']
+        else:
+            self._subdirs = ['']
+        self._toc = None
+        self._dirs = {}
+        self._old_dirs = {}
+        self._start = time.time()
+        # number of directories which had to be listed
+        self.n_listed = 0
+
+    def get_state(self):
+        """Return mtime and listing of all directories, or None if they
+        have not been listed yet.
+
+        """
+        if self._toc is None:
+            return None
+        return {'type': self.type, 'dirs': self._dirs}
+
+    def restore(self, state):
+        """Reuse listings of a previous run for unchanged directories.
+        Must be called before any message is accessed.
+
+        """
+        if state and state['type'] == self.type:
+            self._old_dirs = state['dirs']
+
+    def get_signature(self):
+        """Return mtimes of all directories, which change whenever a message
+        is added, removed or renamed, or None if a directory has changed too
+        recently to rely on its mtime.
+
+        """
+        mtimes = []
+        for subdir in self._subdirs:
+            mtime = os.stat(os.path.join(self.path, subdir)).st_mtime
+            if mtime > self._start - 3:
+                return None
+            mtimes.append(mtime)
+        return tuple(mtimes)
+
+    def _list(self, subdir):
+        path = os.path.join(self.path, subdir)
+        mtime = os.stat(path).st_mtime
+        old = self._old_dirs.get(subdir)
+        if old is not None and old[0] == mtime:
+            entries = old[1]
+        else:
+            entries = list(list_files(path))
+            self.n_listed += 1
+        # a directory changed within the mtime resolution (a few seconds
+        # on some file systems) could change again without a new mtime
+        if mtime > self._start - 3:
+            mtime = None
+        self._dirs[subdir] = (mtime, entries)
+        return entries
+
+    def _refresh(self):
+        if self.type == 'Maildir':
+            # a dict like the one of mailbox.Maildir yields the same order
+            self._toc = {}
+            for subdir in self._subdirs:
+                for name, ino, size, mtime in self._list(subdir):
+                    uniq = name.split(self.colon)[0]
+                    self._toc[uniq] = (os.path.join(subdir, name), ino, size, mtime)
+            self._keys = list(self._toc)
+        else:
+            self._toc = {}
+            for name, ino, size, mtime in self._list(''):
+                if name.isdigit():
+                    self._toc[int(name)] = (name, ino, size, mtime)
+            self._keys = sorted(self._toc)
+        log.debug('listed %d of %d directories of %s', self.n_listed, len(self._subdirs), self.path)
+
+    def _lookup(self, key):
+        if self._toc is None:
+            self._refresh()
+        try:
+            return self._toc[key]
+        except KeyError:
+            raise KeyError('No message with key: %s' % key)
+
+    def iterkeys(self):
+        if self._toc is None:
+            self._refresh()
+        return iter(self._keys)
+
+    def __len__(self):
+        if self._toc is None:
+            self._refresh()
+        return len(self._keys)
+
+    def keys_by_mtime(self):
+        """Return list of keys, sorted by mtime of the messages."""
+        if self._toc is None:
+            self._refresh()
+        return sorted(self._keys, key=lambda k: self._toc[k][3])
+
+    def get_info(self, key):
+        """Return (path, inode, size, mtime) of message key."""
+        relpath, ino, size, mtime = self._lookup(key)
+        return os.path.join(self.path, relpath), ino, size, mtime
+
+    def get_string(self, key):
+        f = open(self.get_info(key)[0], 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def get_message(self, key):
+        return email.message_from_string(self.get_string(key))
@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Identify the language of short texts by their most frequent trigrams.
+
+This is the algorithm of guess_language 0.2 by Kent S Johnson (based on
+Language::Guess by Maciej Ceglowski), with the same results, but with a
+precomputed model which is loaded in a few milliseconds instead of the
+trigram files and the Unicode tables of guess_language, and with a scoring
+which only visits the languages a trigram occurs in.
+
+The model file is generated from the trigrams directory and Blocks.txt of
+guess_language by running this module as a script. It consists of a text
+header, which lists the arrays with their type code, item size and length,
+followed by the little-endian arrays, each aligned to 8 bytes:
+
+languages
+    language codes (e.g. "pt_BR"), separated by line breaks
+trigrams
+    UTF-8 encoded trigrams of all languages, sorted, separated by line
+    breaks
+offsets
+    for each trigram the index of its first posting, and the total
+    number of postings at the end
+posting_languages, posting_ranks
+    for each posting the index of a language and the rank of the trigram
+    in this language
+block_ends
+    first and last code point of each Unicode block
+block_names
+    names of the Unicode blocks, separated by line breaks
+
+"""
+
+import os
+import re
+import sys
+import array
+import bisect
+import codecs
+import unicodedata
+
+model_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'trigrams.dat')
+
+_magic = 'muttlearn trigrams 1'
+_arrays = [
+    ('languages', 'c'),
+    ('trigrams', 'c'),
+    ('offsets', 'I'),
+    ('posting_languages', 'B'),
+    ('posting_ranks', 'H'),
+    ('block_ends', 'I'),
+    ('block_names', 'c'),
+]
+
+# minimal length of a sample to compare trigrams
+min_length = 20
+# number of most frequent trigrams which are compared
+max_grams = 300
+
+_basic_latin = 'en ceb ha so tlh id haw la sw eu nr nso zu xh ss st tn ts'.split()
+_extended_latin = 'cs af pl hr ro sk sl tr hu az et sq ca es fr de nl it da is nb sv fi lv pt ve lt tl cy'.split()
+_all_latin = _basic_latin + _extended_latin
+_cyrillic = 'ru uk kk uz mn sr mk bg ky'.split()
+_arabic = 'ar fa ps ur'.split()
+_devanagari = 'hi ne'.split()
+_portuguese = 'pt_BR pt_PT'.split()
+
+# languages with a script of their own
+_singletons = [
+    ('Armenian', 'hy'),
+    ('Hebrew', 'he'),
+    ('Bengali', 'bn'),
+    ('Gurmukhi', 'pa'),
+    ('Greek', 'el'),
+    ('Gujarati', 'gu'),
+    ('Oriya', 'or'),
+    ('Tamil', 'ta'),
+    ('Telugu', 'te'),
+    ('Kannada', 'kn'),
+    ('Malayalam', 'ml'),
+    ('Sinhala', 'si'),
+    ('Thai', 'th'),
+    ('Lao', 'lo'),
+    ('Tibetan', 'bo'),
+    ('Burmese', 'my'),
+    ('Georgian', 'ka'),
+    ('Mongolian', 'mn-Mong'),
+    ('Khmer', 'km'),
+]
+
+_re_spaces = re.compile(u' +')
+_re_non_ascii = re.compile(u'[^\x00-\x7f]')
+
+def normalize(text):
+    """Return text in NFC with all runs of non-alphabetic characters
+    replaced by a single space.
+
+    """
+    text = unicodedata.normalize('NFC', text)
+    return _re_spaces.sub(u' ', u''.join([c if c.isalpha() else u' ' for c in text]))
+
+def ordered_trigrams(text):
+    """Return the trigrams of text, sorted by decreasing frequency."""
+    text = text.lower()
+    counts = {}
+    for i in xrange(len(text) - 2):
+        t = text[i:i+3]
+        counts[t] = counts.get(t, 0) + 1
+    return sorted(counts, key=lambda t: (-counts[t], t))
+
+def is_known(language, known):
+    """Return True if language is in known, or known is None. Portuguese
+    is known if one of its variants is.
+
+    """
+    return known is None or language in known or \
+            (language == 'pt' and bool(known.intersection(_portuguese)))
+
+def choose(ranking, known=None):
+    """Return the language of ranking (see Model.rank()) which is most
+    similar, out of known if it is a frozenset of language codes, or ''
+    if there is none.
+
+    """
+    if isinstance(ranking, basestring):
+        return ranking
+    for language in ranking:
+        if isinstance(language, tuple):
+            # Portuguese, refined by its variants if one of them is known
+            if known is None or known.intersection(_portuguese):
+                return choose(language, known)
+            language = 'pt'
+        if is_known(language, known):
+            return language
+    return ''
+
+class Model(object):
+    """Trigram ranks of all languages, read from a model file.
+
+    The file is read completely and its arrays are copied, and the
+    trigrams are put into a dict. Memory mapping the file and searching
+    the trigrams there would save this, but the file is small (about
+    130 KB) and read in a few milliseconds, while a dict lookup of each
+    trigram is much faster than a binary search in the file.
+
+    """
+    def __init__(self, path=model_path):
+        f = open(path, 'rb')
+        try:
+            buf = f.read()
+        finally:
+            f.close()
+        self._read(buf)
+        # lists of candidates for each set of known languages
+        self._candidates = {}
+
+    def _read(self, buf):
+        header_end = buf.find('\n\n')
+        header = buf[:header_end].split('\n')
+        if header[0] != _magic:
+            raise ValueError('not a trigram model file')
+        pos = header_end + 2
+        arrays = {}
+        for line in header[1:]:
+            name, typecode, itemsize, n = line.split()
+            a = array.array(typecode)
+            if a.itemsize != int(itemsize):
+                raise ValueError('item size of array %s is %d, not %s' % (name, a.itemsize, itemsize))
+            pos += -pos % 8
+            a.fromstring(buf[pos:pos+a.itemsize*int(n)])
+            if sys.byteorder == 'big':
+                a.byteswap()
+            pos += a.itemsize * int(n)
+            arrays[name] = a
+        self.languages = arrays['languages'].tostring().split('\n')
+        self._language_index = dict((l.lower(), i) for i, l in enumerate(self.languages))
+        trigrams = arrays['trigrams'].tostring().decode('utf-8').split(u'\n')
+        self._trigram_index = dict((t, i) for i, t in enumerate(trigrams))
+        self._offsets = arrays['offsets']
+        self._posting_languages = arrays['posting_languages']
+        self._posting_ranks = arrays['posting_ranks']
+        self._block_ends = arrays['block_ends']
+        self._block_names = arrays['block_names'].tostring().split('\n')
+
+    def block(self, c):
+        """Return name of the Unicode block of character c."""
+        i = bisect.bisect_left(self._block_ends, ord(c))
+        if i >= 2 * len(self._block_names):
+            return 'Unknown'
+        return self._block_names[i // 2]
+
+    def find_scripts(self, text):
+        """Return the names of the Unicode blocks of at least 40% of the
+        characters in the normalized text, and of Basic Latin from 15% and
+        of Latin Extended Additional from 10% on.
+
+        """
+        total = len(text) - text.count(u' ')
+        if not total:
+            return set()
+        counts = {}
+        non_ascii = _re_non_ascii.findall(text)
+        if total > len(non_ascii):
+            counts['Basic Latin'] = total - len(non_ascii)
+        for c in non_ascii:
+            b = self.block(c)
+            counts[b] = counts.get(b, 0) + 1
+        scripts = set()
+        for block, n in counts.iteritems():
+            pct = n * 100 // total
+            if pct >= 40 or (block == 'Basic Latin' and pct >= 15) or \
+                    (block == 'Latin Extended Additional' and pct >= 10):
+                scripts.add(block)
+        return scripts
+
+    def _get_candidates(self, languages):
+        """Return (key, index) of all languages which have a model."""
+        candidates = self._candidates.get(id(languages))
+        if candidates is None:
+            candidates = [(l, self._language_index[l.lower()]) for l in languages
+                          if l.lower() in self._language_index]
+            self._candidates[id(languages)] = candidates
+        return candidates
+
+    def distances(self, text):
+        """Return list of the distances of the trigrams of the normalized
+        text to the ones of each language in self.languages.
+
+        """
+        trigrams = ordered_trigrams(text)[:max_grams]
+        # a trigram which does not occur in a language has the distance
+        # max_grams, so start with that and subtract what is closer
+        distances = [max_grams * len(trigrams)] * len(self.languages)
+        offsets = self._offsets
+        posting_languages = self._posting_languages
+        posting_ranks = self._posting_ranks
+        trigram_index = self._trigram_index
+        for i, t in enumerate(trigrams):
+            k = trigram_index.get(t)
+            if k is None:
+                continue
+            for j in xrange(offsets[k], offsets[k+1]):
+                distances[posting_languages[j]] -= max_grams - abs(i - posting_ranks[j])
+        return distances
+
+    def order(self, distances, languages):
+        """Return tuple of languages which have a model, the most similar
+        one by distances first.
+
+        """
+        return tuple(l for d, l in sorted((distances[i], l)
+                                          for l, i in self._get_candidates(languages)))
+
+    def rank(self, text):
+        """Return the languages text may be written in, to be chosen from
+        by choose(). This is either a language code (or '' if the language
+        is unknown), which is determined by the script alone, or a tuple of
+        the languages whose trigrams are compared, the most similar first.
+        In the tuple, Portuguese is a tuple of its variants.
+
+        """
+        if not text:
+            return ''
+        if isinstance(text, str):
+            text = unicode(text, 'utf-8')
+        text = normalize(text)
+        if len(text) < 3:
+            return ''
+        scripts = self.find_scripts(text)
+        if 'Hangul Syllables' in scripts or 'Hangul Jamo' in scripts or \
+                'Hangul Compatibility Jamo' in scripts or 'Hangul' in scripts:
+            return 'ko'
+        if 'Greek and Coptic' in scripts:
+            return 'el'
+        if 'Katakana' in scripts:
+            return 'ja'
+        if 'CJK Unified Ideographs' in scripts or 'Bopomofo' in scripts or \
+                'Bopomofo Extended' in scripts or 'KangXi Radicals' in scripts:
+            return 'zh'
+        if 'Cyrillic' in scripts:
+            languages = _cyrillic
+        elif 'Arabic' in scripts or 'Arabic Presentation Forms-A' in scripts or \
+                'Arabic Presentation Forms-B' in scripts:
+            languages = _arabic
+        elif 'Devanagari' in scripts:
+            languages = _devanagari
+        else:
+            for block, language in _singletons:
+                if block in scripts:
+                    return language
+            if 'Latin Extended Additional' in scripts:
+                return 'vi'
+            if 'Extended Latin' in scripts:
+                languages = _extended_latin
+            elif 'Basic Latin' in scripts:
+                languages = _all_latin
+            else:
+                return ''
+        # too short to compare trigrams
+        if len(text) < min_length:
+            return ''
+        distances = self.distances(text)
+        ranking = self.order(distances, languages)
+        if languages is _extended_latin:
+            portuguese = self.order(distances, _portuguese)
+            ranking = tuple(portuguese if l == 'pt' else l for l in ranking)
+        return ranking
+
+    def identify(self, text, known=None):
+        """Return the language code of text, or '' if it is unknown. If
+        known is a frozenset of language codes, only these are compared by
+        their trigrams.
+
+        """
+        return choose(self.rank(text), known)
+
+    def rank_batch(self, texts):
+        """Return list of the rankings of all texts, see rank(). Equal
+        texts are only ranked once.
+
+        """
+        results = {}
+        for text in texts:
+            if text not in results:
+                results[text] = self.rank(text)
+        return [results[text] for text in texts]
+
+_model = None
+def get_model():
+    """Return the model of the installed model file, loaded on first use."""
+    global _model
+    if _model is None:
+        _model = Model(model_path)
+    return _model
+
+def write_model(path, trigrams_dir, blocks_path):
+    """Write model file path from the trigrams directory and the Blocks.txt
+    of guess_language.
+
+    """
+    re_line = re.compile(r'(.{3})\s+(.*)')
+    languages = sorted(l for l in os.listdir(trigrams_dir)
+                       if not os.path.isdir(os.path.join(trigrams_dir, l)))
+    postings = {}
+    for i, language in enumerate(languages):
+        ranks = {}
+        for line in codecs.open(os.path.join(trigrams_dir, language), 'r', 'utf-8'):
+            m = re_line.search(line)
+            if m:
+                ranks[m.group(1)] = int(m.group(2))
+        for t, rank in ranks.iteritems():
+            postings.setdefault(t, []).append((i, rank))
+    trigrams = sorted(postings)
+    offsets = array.array('I', [0])
+    posting_languages = array.array('B')
+    posting_ranks = array.array('H')
+    for t in trigrams:
+        for i, rank in sorted(postings[t]):
+            posting_languages.append(i)
+            posting_ranks.append(rank)
+        offsets.append(len(posting_languages))
+
+    re_block = re.compile(r'^(....)\.\.(....); (.*)$')
+    block_ends = array.array('I')
+    block_names = []
+    for line in open(blocks_path):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        start, end, name = re_block.match(line).groups()
+        block_ends.extend([int(start, 16), int(end, 16)])
+        block_names.append(name)
+
+    arrays = {
+        'languages': array.array('c', '\n'.join(languages)),
+        'trigrams': array.array('c', u'\n'.join(trigrams).encode('utf-8')),
+        'offsets': offsets,
+        'posting_languages': posting_languages,
+        'posting_ranks': posting_ranks,
+        'block_ends': block_ends,
+        'block_names': array.array('c', '\n'.join(block_names)),
+    }
+    f = open(path, 'wb')
+    try:
+        f.write(_magic + '\n')
+        for name, typecode in _arrays:
+            a = arrays[name]
+            f.write('%s %s %d %d\n' % (name, typecode, a.itemsize, len(a)))
+        f.write('\n')
+        for name, typecode in _arrays:
+            a = arrays[name]
+            f.write('\0' * (-f.tell() % 8))
+            if sys.byteorder == 'big':
+                a = array.array(typecode, a)
+                a.byteswap()
+            a.tofile(f)
+    finally:
+        f.close()
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        sys.exit('usage: %s MODEL_FILE TRIGRAMS_DIR BLOCKS_TXT' % sys.argv[0])
+    write_model(*sys.argv[1:])
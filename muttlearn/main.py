@@ -13,12 +13,18 @@ import optparse
 import shelve
 import os.path
 import errno
+import time
+import collections
+import mailbox
 
 import scan
+import compressed
+import pipeline
+import spill
 import config
 import output
 import log
-from common import filter_any, __version__
+from common import __version__
 
 cache_recipients_path = os.path.expanduser('~/.muttlearn/cache_recipients')
 def save_recipients(recipients):
@@ -30,7 +36,7 @@ def save_recipients(recipients):
     dstore.close()
 def load_recipients():
     dstore = shelve.open(cache_recipients_path, flag='r', protocol=2)
-    recipients = {}
+    recipients = scan.Recipients()
     for k in dstore:
         r = scan.Recipient(dstore[k]['emails'])
         r.from_dict(dstore[k])
@@ -38,6 +44,9 @@ def load_recipients():
     dstore.close()
     return recipients
 
+cache_mailboxes_path = os.path.expanduser('~/.muttlearn/cache_mailboxes')
+cache_bodies_path = os.path.expanduser('~/.muttlearn/cache_bodies')
+cache_languages_path = os.path.expanduser('~/.muttlearn/cache_languages')
 cache_messages_path = os.path.expanduser('~/.muttlearn/cache_messages')
 cache_messages_tmp_path = cache_messages_path + '.tmp'
 cache_messages_lock_path = cache_messages_path + '.lock'
@@ -77,12 +86,44 @@ def release_lock():
     if os.path.exists(cache_messages_lock_path):
         os.remove(cache_messages_lock_path)
 
+def migrate_cache(version):
+    """Convert message cache of an older version to the current one."""
+    if version < 4 and os.path.exists(cache_mailboxes_path):
+        # identities of messages in the mailbox state have changed,
+        # the state is only needed to speed up scanning
+        log.debug('removing mailbox state of cache version %d', version)
+        os.remove(cache_mailboxes_path)
+    if not os.path.exists(cache_messages_path):
+        return
+    dstore = shelve.open(cache_messages_path, flag='w', protocol=2)
+    if version < 3:
+        # Maildir messages are identified by mailbox and unique name
+        # instead of the file name, which changes with the flags
+        log.debug('migrating Maildir messages in cache to version 3')
+        for identifier in dstore.keys():
+            if '\0' in identifier:
+                continue
+            subdir = os.path.dirname(identifier)
+            # like scan.Mailbox.path
+            mbox_path = os.path.realpath(os.path.dirname(subdir))
+            if os.path.basename(subdir) in ('cur', 'new') and \
+                    os.path.isdir(os.path.join(mbox_path, 'cur')):
+                uniq = os.path.basename(identifier).split(mailbox.Maildir.colon)[0]
+                dstore['%s\0%s' % (mbox_path, uniq)] = dstore[identifier]
+                del dstore[identifier]
+    dstore.close()
+
+# number of messages which may be queued per worker process
+max_pending_per_job = 32
+# number of messages which may be queued between the stages of the scan
+max_queued_per_stage = 64
+
 def gen_recipients_from_cache(options, progress=False):
     if not os.path.exists(cache_messages_path):
-        return {}
-    max_age = options['max_age']
+        return scan.Recipients()
     dstore = shelve.open(cache_messages_path, flag='r', protocol=2)
-    recipients = {}
+    recipients = scan.Recipients()
+    seen = {}
     n_messages = len(dstore)
     log.info('cache only, %d messages', n_messages)
     if progress:
@@ -91,85 +132,367 @@ def gen_recipients_from_cache(options, progress=False):
         if progress:
             pstatus.inc()
             pstatus.output()
-        msg = scan.Message()
-        msg.from_dict_only(dstore[identifier])
-        if options['skip_multiple_recipients'] and len(msg.to_emails) > 1:
-            continue
-        if options['exclude_mails_to_me'] and filter_any(config.is_this_me, msg.to_emails):
+        d = dstore[identifier]
+        if d.get('header_only') or d.get('rejected'):
             continue
-        if options['only_include_mails_from_me'] and not config.is_this_me(msg.from_email):
+        msgid = d.get('msgid')
+        if msgid in seen:
+            add_copy(recipients, seen, msgid, d['mbox_path'])
             continue
-        if max_age >= 0 and msg.age > max_age:
+        scan.add_language_ranking(d)
+        msg = scan.Message()
+        msg.from_dict_only(d)
+        if not msg.is_wanted(options):
             continue
-        if msg.to_emails_str not in recipients:
-            r = scan.Recipient(msg.to_emails, msg)
-            recipients[msg.to_emails_str] = r
-        else:
-            recipients[msg.to_emails_str].add(msg)
+        if msgid:
+            seen[msgid] = (msg.to_emails_str, msg.age)
+        recipients.add(msg)
     if progress:
         pstatus.finish()
     dstore.close()
     return recipients
 
-def gen_recipients(mailboxes, options, use_cache=True, clean_cache=False, progress=False):
+def add_copy(recipients, seen, msgid, mbox_path):
+    """Count another copy of the message msgid, which has been found in
+    mbox_path, only for the fcc statistics.
+
+    """
+    if seen[msgid] is not None:
+        key, age = seen[msgid]
+        recipients.add_fcc(key, mbox_path, age)
+
+def add_message(recipients, seen, msg, max_age):
+    """Add msg, which has passed the header filters, to its recipient,
+    unless it is older than max_age.
+
+    """
+    if max_age >= 0 and msg.age > max_age:
+        if msg.msgid:
+            seen[msg.msgid] = None
+        return
+    if msg.msgid:
+        seen[msg.msgid] = (msg.to_emails_str, msg.age)
+    recipients.add(msg)
+
+def get_contribution(msg):
+    """Return what msg contributes to its recipient, independent of the
+    current time.
+
+    """
+    return (msg.time, msg.to_emails) + tuple(getattr(msg, v) for v in scan.Recipient.values)
+
+def replay_contributions(contributions, recipients, seen, mbox_path, max_age):
+    """Add the messages of an unchanged mailbox from the contributions
+    stored by a previous run, without accessing the mailbox or the message
+    cache.
+
+    contributions is a list of (msgid, c) in the order in which the
+    messages have been added, where c is the result of get_contribution(),
+    'filtered' or 'rejected' if the message has not been used, or None if
+    it has been counted as copy of a message with the same Message-ID.
+    Returns False without adding anything if a copy can not be counted as
+    such anymore, because the message it was a copy of is gone.
+
+    """
+    added = set()
+    for msgid, c in contributions:
+        if c is None and msgid not in seen and msgid not in added:
+            return False
+        added.add(msgid)
+    for msgid, c in contributions:
+        if c == 'rejected':
+            if msgid:
+                seen.setdefault(msgid, None)
+        elif msgid and msgid in seen:
+            add_copy(recipients, seen, msgid, mbox_path)
+        elif c == 'filtered':
+            if msgid:
+                seen[msgid] = None
+        else:
+            msg = scan.Message()
+            msg.msgid = msgid
+            msg.set_time(c[0])
+            msg.to_emails = c[1]
+            for v, value in zip(scan.Recipient.values, c[2:]):
+                setattr(msg, v, value)
+            add_message(recipients, seen, msg, max_age)
+    return True
+
+# cache dictionary of messages which have to be analyzed
+not_cached = {}
+
+def lookup_messages(messages, dstore, use_cache=True, seen=(), deadline=None):
+    """Look up messages in the cache. After the time deadline, messages
+    which are not cached (or have changed) are skipped.
+
+    Yields (msg, d, cached), where d is the cache dictionary of msg, None if
+    msg has a Message-ID in seen, or not_cached if msg has to be analyzed.
+
+    """
+    for msg in messages:
+        if msg.msgid and msg.msgid in seen:
+            yield msg, None, False
+            continue
+        d = dstore.get(msg.identifier)
+        if use_cache and d and not msg.has_changed(d):
+            yield msg, d, True
+        elif deadline is None or time.time() <= deadline:
+            yield msg, not_cached, False
+
+def analyze_messages(results, pool=None, max_pending=0, reader=None):
+    """Analyze the messages of results of lookup_messages() which are not
+    cached, or only partially for filters which have changed since, in the
+    worker processes of pool if given. Otherwise files of directory
+    mailboxes are read in advance by the threads of reader if given, at
+    most max_pending messages ahead.
+
+    Yields (msg, d, cached) in the original order, where d is the cache
+    dictionary of msg, or None if msg has a Message-ID in seen.
+
+    """
+    def result(msg, d, cached, job):
+        if job == 'read':
+            # only read in advance
+            d.get()
+            return msg, scan.analyze_message(msg), cached
+        if job == 'analyze':
+            d, updates, hits, memo_counts = d.get()
+            # written to the body cache after the workers have finished
+            scan.body_cache_updates.update(updates)
+            scan.body_cache_hits += hits
+            for memo, (memo_hits, memo_misses) in zip((scan.header_memo, scan.addresses_memo),
+                                                      memo_counts):
+                memo.hits += memo_hits
+                memo.misses += memo_misses
+        return msg, d, cached
+
+    pending = collections.deque()
+    for msg, d, cached in results:
+        if cached and d.get('header_only'):
+            msg.from_dict(d)
+            if msg.is_wanted(scan.filter_options):
+                # filters have changed since the message was scanned
+                d, cached = not_cached, False
+        elif cached and scan.add_language_ranking(d):
+            # the language has been left to guess per recipient, the
+            # completed dictionary is stored like a new one
+            msg.update_position(d)
+            cached = False
+        if d is not not_cached:
+            pending.append((msg, d, cached, None))
+        elif pool is not None:
+            # read message here, workers can not access the mailbox,
+            # but files of directory mailboxes by their path
+            if not msg.is_single_file:
+                msg.get_string()
+            pending.append((msg, pool.apply_async(scan.analyze_message_in_worker, (msg,)),
+                            False, 'analyze'))
+        elif reader is not None and msg.is_single_file:
+            pending.append((msg, reader.apply_async(msg.get_string), False, 'read'))
+        else:
+            pending.append((msg, scan.analyze_message(msg), False, None))
+        while pending and (len(pending) > max_pending or not pending[0][3] or pending[0][1].ready()):
+            yield result(*pending.popleft())
+    while pending:
+        yield result(*pending.popleft())
+
+def until_too_old(results, max_age, cutoff, path):
+    """Pass results of analyze_messages() for messages in newest-first
+    order, until cutoff messages in a row are older than max_age.
+
+    """
+    n_old = 0
+    for msg, d, cached in results:
+        yield msg, d, cached
+        if d is None or d.get('rejected'):
+            continue
+        if scan.get_age(d['time']) <= max_age:
+            n_old = 0
+            continue
+        n_old += 1
+        if n_old >= cutoff:
+            log.debug('%s: %d messages in a row older than max_age, skipping the rest',
+                      path, cutoff)
+            return
+
+def gen_recipients(mailboxes, options, use_cache=True, clean_cache=False, progress=False, jobs=1,
+                   deadline=None):
     base = os.path.dirname(cache_messages_path)
     if not os.path.exists(base):
         os.makedirs(base)
     if not os.path.exists(cache_messages_path):
         # if there is no cache, it doesn't need to be cleaned
         clean_cache = False
-    max_age = options['max_age']
     flag = 'r' if clean_cache else 'c'
     dstore = shelve.open(cache_messages_path, flag=flag, protocol=2)
     dstore_write = shelve.open(cache_messages_tmp_path, flag='n', protocol=2) if clean_cache else dstore
-    recipients = {}
+    mstore = shelve.open(cache_mailboxes_path, flag='c', protocol=2)
+    # unused entries are only removed when cleaning the cache
+    flag_bodies = 'n' if clean_cache or not use_cache else 'c'
+    bstore = shelve.open(cache_bodies_path, flag=flag_bodies, protocol=2)
+    pool = None
+    if jobs > 1:
+        # the worker processes open the body cache for reading, while
+        # their new entries are collected and written by this one after
+        # they have finished
+        bstore.close()
+        bstore = None
+        scan.body_cache_updates = {}
+        # delayed import, not needed for the default serial scan
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs, scan.init_worker, (cache_bodies_path,))
+    reader = None
+    max_pending = jobs*max_pending_per_job
+    if pool is None and options['readahead'] > 0:
+        # threads are enough to wait for the file system
+        from multiprocessing.pool import ThreadPool
+        reader = ThreadPool(options['readahead'])
+        max_pending = options['readahead']
+    scan.body_cache = bstore
+    # reading, cache lookup and analysis may run in threads of their own,
+    # the messages are added in this one
+    engine = pipeline.Pipeline(['read', 'lookup', 'analyze', 'aggregate'],
+                               max_queued_per_stage, threaded=options['pipeline'])
+    dstore_read = pipeline.LockedMapping(dstore)
+    if dstore_write is dstore:
+        dstore_write = dstore_read
+    # with a memory limit, recipients are spilled to temporary files and
+    # no per-message state of the mailboxes is kept
+    bounded = options['max_memory'] > 0
+    if bounded:
+        recipients = scan.SpilledRecipients(options['max_memory'] * 1024 * 1024)
+    else:
+        recipients = scan.Recipients()
+    # recipients key and age of added messages by Message-ID, or None
+    # if the message has not been added; on disk if memory is bounded,
+    # since it grows with the number of messages
+    seen = spill.SpilledMapping() if bounded else {}
+    newest_first = options['newest_first'] and options['max_age'] >= 0
+    # with a deadline, the most valuable messages are analyzed first: the
+    # mailboxes are visited starting with the latest modified one, each
+    # starting with its newest message
+    reverse = newest_first or deadline is not None
+    if deadline is not None:
+        mailboxes = sorted(mailboxes, key=lambda mb: -mb.get_mtime())
     n_mailboxes = len(mailboxes)
-    for i, mb in enumerate(mailboxes):
-        if progress:
-            n_messages = len(mb)
-            log.info('[%d/%d] %s: %d messages', i+1, n_mailboxes, mb.path, n_messages)
-            pstatus = log.PercentStatus(n_messages, prefix='      ')
-        for msg in mb.messages():
+    try:
+        for i, mb in enumerate(mailboxes):
+            signature = mb.get_signature()
+            state = mstore.get(mb.path) if use_cache else None
+            if bounded:
+                mb.remember_identities = False
+            # when cleaning the cache, all messages have to be looked up
+            if state and not clean_cache and not bounded and signature is not None and \
+                    state.get('signature') == signature and \
+                    state.get('fingerprint') == scan.filter_fingerprint and \
+                    replay_contributions(state['contributions'], recipients, seen,
+                                         mb.path, options['max_age']):
+                if progress:
+                    log.info('[%d/%d] %s: unchanged', i+1, n_mailboxes, mb.path)
+                continue
+            mb.restore_state(state)
             if progress:
-                pstatus.inc()
-                pstatus.output()
-            d = dstore.get(msg.identifier)
-            if use_cache and d and not msg.has_changed(d):
-                msg.from_dict(d)
-                if clean_cache:
+                n_messages = len(mb)
+                log.info('[%d/%d] %s: %d messages', i+1, n_mailboxes, mb.path, n_messages)
+                pstatus = log.PercentStatus(n_messages, prefix='      ')
+            results = engine.run(mb.messages(reverse),
+                lambda messages: lookup_messages(messages, dstore_read, use_cache, seen, deadline),
+                lambda results: analyze_messages(results, pool, max_pending, reader))
+            if newest_first:
+                results = until_too_old(results, options['max_age'],
+                                        options['max_age_cutoff'], mb.path)
+            if reverse:
+                # added in the original order, the results do not depend
+                # on the scan order
+                results = reversed(list(results))
+            # (msgid, contribution) of all messages, see replay_contributions(),
+            # which are discarded if bounded
+            contributions = []
+            contribute = contributions.append if not bounded else lambda item: None
+            for msg, d, cached in results:
+                if progress:
+                    pstatus.inc()
+                    pstatus.output()
+                if d is None:
+                    pass
+                elif cached and msg.update_position(d):
+                    # unchanged, but moved within the mailbox
                     dstore_write[msg.identifier] = d
-            else:
-                if not msg.parse_header():
-                    continue
-                d = {}
-                msg.parse_body()
-                if msg.identifier:
-                    msg.to_dict(d)
+                elif not cached or clean_cache:
                     dstore_write[msg.identifier] = d
-
-            if options['skip_multiple_recipients'] and len(msg.to_emails) > 1:
-                continue
-            if options['exclude_mails_to_me'] and filter_any(config.is_this_me, msg.to_emails):
-                continue
-            if options['only_include_mails_from_me'] and not config.is_this_me(msg.from_email):
-                continue
-            if max_age >= 0 and msg.age > max_age:
-                continue
-
-            if msg.to_emails_str not in recipients:
-                r = scan.Recipient(msg.to_emails, msg)
-                recipients[msg.to_emails_str] = r
-            else:
-                recipients[msg.to_emails_str].add(msg)
-        if progress:
-            pstatus.finish()
+                # the lookup may have been done before the previous
+                # messages have been added
+                if d is None or (msg.msgid and msg.msgid in seen):
+                    # copy of a message which has already been seen
+                    contribute((msg.msgid, None))
+                    add_copy(recipients, seen, msg.msgid, msg.mbox_path)
+                    continue
+                if d.get('rejected'):
+                    contribute((msg.msgid, 'rejected'))
+                    if msg.msgid:
+                        seen.setdefault(msg.msgid, None)
+                    continue
+                msg.from_dict(d)
+                if msg.msgid in seen:
+                    contribute((msg.msgid, None))
+                    add_copy(recipients, seen, msg.msgid, msg.mbox_path)
+                    continue
+                # max_age is checked by add_message(), the contribution is
+                # reused while the message is young enough. Messages which
+                # are still only analyzed partially are older than max_age,
+                # which is part of the filter fingerprint.
+                if not msg.is_wanted(options, check_age=False) or d.get('header_only'):
+                    contribute((msg.msgid, 'filtered'))
+                    if msg.msgid:
+                        seen[msg.msgid] = None
+                    continue
+                contribute((msg.msgid, get_contribution(msg)))
+                add_message(recipients, seen, msg, options['max_age'])
+            engine.stop()
+            if progress:
+                pstatus.finish()
+            state = mb.get_state()
+            if state is None:
+                state = {}
+            # only reusable if no message has been skipped
+            if not bounded and (deadline is None or time.time() <= deadline) and \
+                    (not newest_first or len(contributions) == len(mb)):
+                state['signature'] = signature
+                state['fingerprint'] = scan.filter_fingerprint
+                state['contributions'] = contributions
+            if state:
+                mstore[mb.path] = state
+    finally:
+        engine.stop()
+        if pool is not None:
+            # all results have been collected at this point
+            pool.terminate()
+            bstore = shelve.open(cache_bodies_path, flag='c', protocol=2)
+            for key, analysis in scan.body_cache_updates.iteritems():
+                bstore[key] = analysis
+            scan.body_cache_updates = None
+        if reader is not None:
+            reader.terminate()
+        if bounded:
+            seen.close()
+        scan.body_cache = None
+        bstore.close()
+    log.debug('analysis of %d message bodies taken from cache', scan.body_cache_hits)
+    # including the hits and misses in the worker processes
+    log.debug('decoded headers taken from memo: %.0f%% of %d, addresses: %.0f%% of %d',
+              scan.header_memo.hit_rate(), scan.header_memo.hits + scan.header_memo.misses,
+              scan.addresses_memo.hit_rate(), scan.addresses_memo.hits + scan.addresses_memo.misses)
+    engine.log_stats()
+    if deadline is not None and time.time() > deadline:
+        log.info('time budget exhausted, not all messages have been analyzed, '
+                 'run again to continue')
+    mstore.close()
     dstore.close()
     if clean_cache:
         dstore_write.close()
         os.rename(cache_messages_tmp_path, cache_messages_path)
     return recipients
 
-
 def main(argv=None):
 
     if not argv:
@@ -217,13 +540,27 @@ def main(argv=None):
         help='remove unused messages from the cache')
     parser.add_option('--output-only', action='store_true', default=False,
         help='do not scan messages, just output (very fast)')
+    parser.add_option('--time-budget', type='float', default=None, metavar='SECONDS',
+        help='analyze messages for at most SECONDS, then output; the next run '
+             'continues with the cached results. Mailboxes are scanned by '
+             'modification time and their messages from the end, newest first')
+    parser.add_option('-j', '--jobs', type='int', default=1, metavar='N',
+        help='analyze messages and decompress mailboxes in N parallel processes')
 
     options, args = parser.parse_args(argv[1:])
+    deadline = None
+    if options.time_budget is not None:
+        deadline = time.time() + options.time_budget
 
     log.verbosity = options.verbosity
 
     if not options.read_muttrc and options.muttrc:
         parser.error('-n and --muttrc cannot both be specified')
+    if options.jobs < 1:
+        parser.error('number of jobs must be at least 1')
+    if options.time_budget is not None and options.time_budget <= 0:
+        parser.error('time budget must be positive')
+    compressed.jobs = options.jobs
 
     config.init(conf_path=options.muttlearnrc,
                 mutt_conf_path=options.muttrc,
@@ -249,6 +586,10 @@ def main(argv=None):
         use_cache = False
     else:
         use_cache = not config.db_needs_rebuilding()
+    if use_cache and config.db_version() < config.cache_version:
+        migrate_cache(config.db_version())
+        log.debug('migrated message cache to version %d', config.cache_version)
+        config.save_to_cache()
     if not use_cache:
         options.clean_cache = True
         log.debug('rebuilding message cache (slow!)')
@@ -256,20 +597,22 @@ def main(argv=None):
     else:
         log.debug('using message cache (faster)')
 
+    scan.init(config.options())
+
     if options.output_only:
         #recipients = load_recipients()
         recipients = gen_recipients_from_cache(config.options(),
                                                progress=options.progress)
     else:
-        scan.init(config.options())
-    
         mailboxes = [scan.Mailbox(path, 'auto') for path in mailbox_paths]
     
         recipients = gen_recipients(mailboxes,
                                     config.options(),
                                     use_cache=use_cache,
                                     clean_cache=options.clean_cache,
-                                    progress=options.progress)
+                                    progress=options.progress,
+                                    jobs=options.jobs,
+                                    deadline=deadline)
 
         #save_recipients(recipients)
 
@@ -282,12 +625,21 @@ def main(argv=None):
             log.error('error opening output file: %s', e)
 
 
+    if scan.language_per_recipient:
+        # languages are guessed while the recipients are output, unused
+        # entries are only removed when cleaning the cache
+        flag = 'n' if options.clean_cache else 'c'
+        scan.language_cache = shelve.open(cache_languages_path, flag=flag, protocol=2)
     mutt_out = output.MuttOutput(outfile, config.options())
     mutt_out.output_header()
-    # result is sorted, so that larger address groups are matched later.
-    # Also comparison of output files is easier when debugging.
-    for addr in sorted(recipients, key=lambda x:(len(x),x)):
-        mutt_out.output_recipient(recipients[addr])
+    try:
+        for r in recipients.in_output_order():
+            mutt_out.output_recipient(r)
+    finally:
+        recipients.close()
+        if scan.language_cache is not None:
+            scan.language_cache.close()
+            scan.language_cache = None
 
     if options.output != '-':
         outfile.close()
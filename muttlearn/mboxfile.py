@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Fast read-only access to mbox and MMDF mailboxes."""
+
+import os
+import time
+import mmap
+import zlib
+import array
+import email
+import threading
+
+import compressed
+
+_mmdf_sep = '\x01\x01\x01\x01\n'
+
+def find_line(buf, s, pos):
+    """Return offset of the first line starting with s at or after the line
+    starting at pos, or -1 if there is none.
+
+    """
+    if buf[pos:pos+len(s)] == s:
+        return pos
+    i = buf.find('\n' + s, pos)
+    return i + 1 if i >= 0 else -1
+
+def scan_mbox(buf, pos=0):
+    """Generate (start, stop) offsets of all messages in mbox buf.
+
+    The boundaries are the same as the ones of mailbox.mbox, but instead
+    of reading the file line by line only the "From " lines are searched.
+
+    """
+    start = find_line(buf, 'From ', pos)
+    while start >= 0:
+        next = buf.find('\nFrom ', start)
+        if next >= 0:
+            next += 1
+        stop = next if next >= 0 else len(buf)
+        # do not include the empty line which precedes the next message
+        if stop > start + 1 and buf[stop-2:stop] == '\n\n':
+            stop -= 1
+        yield start, stop
+        start = next
+
+def scan_mmdf(buf, pos=0):
+    """Generate (start, stop) offsets of all messages in MMDF buf, with the
+    same boundaries as mailbox.MMDF.
+
+    """
+    start = find_line(buf, _mmdf_sep, pos)
+    while start >= 0:
+        start += len(_mmdf_sep)
+        end = find_line(buf, _mmdf_sep, start)
+        if end < 0:
+            yield start, len(buf)
+            break
+        yield start, end - 1
+        start = find_line(buf, _mmdf_sep, end + len(_mmdf_sep))
+
+class MboxFile(object):
+    """A read-only mbox or MMDF mailbox, which may be compressed by gzip or
+    bz2.
+
+    The file is memory mapped, the table of contents is built while
+    iterating over the keys and stored compactly as arrays of offsets, and
+    messages can be accessed without copying them by get_buffer(). Compressed files are decompressed into a
+    temporary file for scanning, but not if the table of contents can be
+    restored from a previous run. Messages which are already in the table
+    of contents can be accessed from several threads.
+
+    """
+    _scanners = {
+        'mbox': scan_mbox,
+        'MMDF': scan_mmdf,
+    }
+
+    def __init__(self, path, type='mbox'):
+        self.path = path
+        self.type = type
+        self._start = time.time()
+        st = os.stat(path)
+        self.size = st.st_size
+        self.mtime = st.st_mtime
+        self._compressed = None
+        if compressed.compression(path):
+            self._compressed = compressed.DecompressedFile(path)
+        self._map = None
+        # for mapping the file and reading compressed files
+        self._lock = threading.Lock()
+        self._scan = None
+        self._scan_pos = 0
+        # start and stop offsets of the messages
+        self._starts = array.array('l')
+        self._stops = array.array('l')
+        self._toc_complete = False
+        # number of messages known to be unchanged since the last scan
+        self.n_unchanged = 0
+
+    def _get_map(self):
+        self._lock.acquire()
+        try:
+            return self._get_map_locked()
+        finally:
+            self._lock.release()
+
+    def _get_map_locked(self):
+        if self._map is None:
+            if self._compressed is not None:
+                self._map = self._compressed.mmap()
+            else:
+                f = open(self.path, 'rb')
+                try:
+                    # empty files can not be mapped
+                    if f.read(1):
+                        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    else:
+                        self._map = ''
+                finally:
+                    f.close()
+        return self._map
+
+    def _resume_pos(self, key):
+        """Return offset of the separator line of message key."""
+        start = self._starts[key]
+        return start - len(_mmdf_sep) if self.type == 'MMDF' else start
+
+    def get_state(self):
+        """Return table of contents and enough information to check later
+        if the file has only been appended to, or None if the table of
+        contents is incomplete.
+
+        """
+        if not self._toc_complete:
+            return None
+        mtime = self.mtime
+        # a file changed within the mtime resolution could change again
+        # without a new mtime, its table of contents is not reused as is
+        if mtime > self._start - 3:
+            mtime = None
+        # arrays would be pickled as lists
+        state = {
+            'type': self.type,
+            'size': self.size,
+            'mtime': mtime,
+            'starts': self._starts.tostring(),
+            'stops': self._stops.tostring(),
+        }
+        if self._starts:
+            state['resume'] = self._resume_pos(len(self._starts) - 1)
+            if self._compressed is None:
+                state['tail'] = zlib.adler32(buffer(self._get_map(), state['resume']))
+        if self._compressed is not None:
+            state['compressed'] = self._compressed.get_state()
+        return state
+
+    def restore(self, state):
+        """Reuse table of contents of a previous scan, as far as the file
+        has not been changed since. Must be called before any message is
+        accessed.
+
+        If the file has grown, the last known message and everything after
+        it is scanned again, if the last known message is still the same.
+        Otherwise the file has been rewritten and is scanned completely.
+        Compressed files are only reused if they have not changed at all.
+
+        """
+        if not state or state['type'] != self.type or not state.get('starts'):
+            return
+        if state['size'] == self.size and state['mtime'] == self.mtime:
+            self._starts.fromstring(state['starts'])
+            self._stops.fromstring(state['stops'])
+            self._toc_complete = True
+            if self._compressed is not None:
+                self._compressed.restore(state['compressed'])
+        elif self._compressed is None and state['size'] < self.size and \
+                zlib.adler32(buffer(self._get_map(), state['resume'], state['size'] - state['resume'])) == state['tail']:
+            self._starts.fromstring(state['starts'])
+            self._stops.fromstring(state['stops'])
+            self._starts.pop()
+            self._stops.pop()
+            self._scan_pos = state['resume']
+        self.n_unchanged = len(self._starts)
+
+    def _scan_next(self):
+        if self._scan is None:
+            self._scan = self._scanners[self.type](self._get_map(), self._scan_pos)
+        for start, stop in self._scan:
+            self._starts.append(start)
+            self._stops.append(stop)
+            return True
+        self._toc_complete = True
+        return False
+
+    def _lookup(self, key):
+        while key >= len(self._starts) and not self._toc_complete:
+            self._scan_next()
+        try:
+            return self._starts[key], self._stops[key]
+        except IndexError:
+            raise KeyError('No message with key: %s' % key)
+
+    def iterkeys(self):
+        key = 0
+        while key < len(self._starts) or (not self._toc_complete and self._scan_next()):
+            yield key
+            key += 1
+
+    def __len__(self):
+        while not self._toc_complete:
+            self._scan_next()
+        return len(self._starts)
+
+    def get_offset(self, key):
+        """Return offset of message key in the (decompressed) file."""
+        return self._lookup(key)[0]
+
+    def get_buffer(self, key):
+        """Return message without the From_ line, without copying it."""
+        start, stop = self._lookup(key)
+        if self._map is None and self._compressed is not None:
+            # only decompress what is needed
+            self._lock.acquire()
+            try:
+                s = self._compressed.read(start, stop)
+            finally:
+                self._lock.release()
+            eol = s.find('\n')
+            return s[eol+1:] if eol >= 0 else ''
+        map = self._get_map()
+        # the end argument of find() is not available in Python 2.5
+        eol = map.find('\n', start)
+        start = eol + 1 if 0 <= eol < stop else stop
+        return buffer(map, start, stop - start)
+
+    def get_string(self, key):
+        """Return message without the From_ line."""
+        return str(self.get_buffer(key))
+
+    def get_message(self, key):
+        return email.message_from_string(self.get_string(key))
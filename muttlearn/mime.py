@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Find the text of MIME messages without parsing all parts.
+
+The messages are given as str or buffer with offsets, only header blocks
+and the text part which is finally used are copied. The parts are the same
+as found by email.message_from_string() and email.message.Message.walk().
+
+"""
+
+import re
+import email.parser
+
+_re_empty_line = re.compile(r'^\r?$', re.M)
+
+def header_end(buf, start=0, stop=None):
+    """Return offset of the empty line after the header of the message in
+    buf[start:stop], or stop if there is none.
+
+    """
+    if stop is None:
+        stop = len(buf)
+    m = _re_empty_line.search(buf, start, stop)
+    return m.start() if m else stop
+
+def parse_header(buf, start=0, stop=None):
+    """Parse header of the message in buf[start:stop].
+
+    Return an email.message.Message without payload and the offset of the
+    body.
+
+    """
+    if stop is None:
+        stop = len(buf)
+    m = _re_empty_line.search(buf, start, stop)
+    end = m.start() if m else stop
+    msg = email.parser.HeaderParser().parsestr(buf[start:end])
+    body = msg.get_payload()
+    msg.set_payload(None)
+    if body:
+        # a line which is not a header starts the body, including
+        # the empty line
+        return msg, end - len(body)
+    return msg, min(m.end() + 1, stop) if m else stop
+
+def iter_parts(buf, start, stop, boundary):
+    """Generate (start, stop) offsets of the parts of the multipart body
+    buf[start:stop], separated by boundary.
+
+    As in email.feedparser, repeated boundary lines do not enclose empty
+    parts. The line break before the next boundary is not removed.
+
+    """
+    re_sep = re.compile(r'^--%s(--)?[ \t]*\r?$' % re.escape(boundary), re.M)
+    m = re_sep.search(buf, start, stop)
+    while m and not m.group(1):
+        while m:
+            pos = min(m.end() + 1, stop)
+            m = re_sep.match(buf, pos, stop)
+        m = re_sep.search(buf, pos, stop)
+        yield pos, m.start() if m else stop
+
+def iter_blocks(buf, start, stop):
+    """Generate (start, stop) offsets of the blocks of the
+    message/delivery-status body buf[start:stop], which are separated by
+    an empty line. As in email.feedparser, there is at least one block, and
+    each further empty line starts another (empty) block.
+
+    """
+    pos = start
+    while True:
+        m = _re_empty_line.search(buf, pos, stop)
+        yield pos, m.start() if m else stop
+        if not m:
+            break
+        pos = m.end() + 1
+        if pos >= stop:
+            break
+
+def strip_line_break(buf, start, stop):
+    """Return stop without the line break at the end of buf[start:stop]."""
+    if stop > start and buf[stop-1] == '\n':
+        stop -= 1
+    if stop > start and buf[stop-1] == '\r':
+        stop -= 1
+    return stop
+
+def find_text_part(msg, buf, start, stop=None, in_multipart=False):
+    """Return the first text/plain part of the message in buf, whose header
+    msg has been parsed by parse_header() and whose body is buf[start:stop].
+
+    The part is an email.message.Message with its payload set, or None if
+    there is no text/plain part. Attachments are skipped without being
+    parsed or decoded.
+
+    """
+    if stop is None:
+        stop = len(buf)
+    ctype = msg.get_content_type()
+    if ctype == 'text/plain':
+        if in_multipart:
+            # the line break before a boundary belongs to the boundary
+            stop = strip_line_break(buf, start, stop)
+        msg.set_payload(buf[start:stop])
+        return msg
+    maintype = msg.get_content_maintype()
+    if maintype == 'multipart':
+        boundary = msg.get_boundary()
+        if boundary is None:
+            return None
+        for part_start, part_stop in iter_parts(buf, start, stop, boundary):
+            part, body = parse_header(buf, part_start, part_stop)
+            if ctype == 'multipart/digest':
+                part.set_default_type('message/rfc822')
+            text = find_text_part(part, buf, body, part_stop, True)
+            if text is not None:
+                return text
+    elif ctype == 'message/delivery-status':
+        # blocks of headers, which are text/plain by default
+        blocks = list(iter_blocks(buf, start, stop))
+        for i, (block_start, block_stop) in enumerate(blocks):
+            if in_multipart and i == len(blocks) - 1:
+                # the line break before a boundary is removed from the
+                # message which has been parsed last
+                block_stop = strip_line_break(buf, block_start, block_stop)
+            part = email.parser.HeaderParser().parsestr(buf[block_start:block_stop])
+            if part.get_content_type() == 'text/plain':
+                return part
+    elif maintype == 'message':
+        part, body = parse_header(buf, start, stop)
+        return find_text_part(part, buf, body, stop, in_multipart)
+    return None
@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Run the stages of a scan in separate threads, connected by bounded
+queues, so that waiting for the file system and analyzing overlap."""
+
+import sys
+import time
+import threading
+import Queue
+
+import log
+
+# marks the end of the items in a queue
+_end = object()
+
+class _Error(object):
+    """Exception raised in a stage, passed on instead of the next item."""
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class StageStats(object):
+    """Time spent by a stage in total and waiting for its neighbours."""
+    def __init__(self, name):
+        self.name = name
+        self.total = 0.0
+        self.wait_input = 0.0
+        self.wait_output = 0.0
+        self.n_batches = 0
+        # sum of the lengths of the output queue before each put
+        self.queued = 0
+
+    def busy(self):
+        return self.total - self.wait_input - self.wait_output
+
+class LockedMapping(object):
+    """Mapping (e.g. a shelve) which can be read and written by several
+    threads at once.
+
+    """
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            return self.mapping.get(key, default)
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, value):
+        self._lock.acquire()
+        try:
+            self.mapping[key] = value
+        finally:
+            self._lock.release()
+
+class Pipeline(object):
+    """Chain of stages, each of which runs in its own thread, except the
+    last one, which consumes the items in the calling thread.
+
+    Items are passed on in batches of up to batch_size items, to reduce
+    the synchronization overhead, but at most max_delay seconds after
+    they have been produced. Each queue holds up to maxsize items.
+    Statistics are collected over all runs, see log_stats().
+
+    If threaded is False, the stages are simply chained and run in the
+    calling thread.
+
+    """
+    def __init__(self, names, maxsize=64, batch_size=16, max_delay=0.01, threaded=True):
+        self.threaded = threaded
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.queue_size = max(1, maxsize // batch_size)
+        self.stats = [StageStats(name) for name in names]
+        self._threads = []
+        self._queues = []
+        self._stopped = False
+        self._start = None
+
+    def run(self, source, *funcs):
+        """Start iterating over source and passing its items through funcs,
+        each of which takes an iterable and returns an iterable.
+
+        Returns an iterator over the results of the last function. The
+        pipeline has to be stopped by stop() afterwards, even if the
+        results have not been consumed completely.
+
+        """
+        assert len(funcs) + 2 == len(self.stats)
+        if not self.threaded:
+            for func in funcs:
+                source = func(source)
+            return iter(source)
+        self._stopped = False
+        self._start = time.time()
+        self._queues = [Queue.Queue(self.queue_size) for f in funcs] + \
+                [Queue.Queue(self.queue_size)]
+        self._threads = []
+        stages = [lambda items: source] + list(funcs)
+        for i, func in enumerate(stages):
+            items = self._iter_queue(self._queues[i-1], self.stats[i]) if i > 0 else None
+            t = threading.Thread(target=self._run_stage,
+                                 args=(func, items, self._queues[i], self.stats[i]))
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+        return self._iter_queue(self._queues[-1], self.stats[-1], interruptible=True)
+
+    def stop(self):
+        """Wait until all stages have finished, abort them if the results
+        have not been consumed completely.
+
+        """
+        self._stopped = True
+        for t in self._threads:
+            while t.isAlive():
+                # unblock stages waiting for free space in their queues
+                # or for more input
+                for q in self._queues:
+                    try:
+                        while True:
+                            q.get_nowait()
+                    except Queue.Empty:
+                        pass
+                    try:
+                        q.put_nowait(_end)
+                    except Queue.Full:
+                        # refilled by a stage still running, drained
+                        # again in the next round
+                        pass
+                t.join(0.01)
+        if self._start is not None:
+            self.stats[-1].total += time.time() - self._start
+            self._start = None
+        self._threads = []
+        self._queues = []
+
+    def _run_stage(self, func, items, out, stats):
+        start = time.time()
+        try:
+            batch = []
+            for item in func(items):
+                if self._stopped:
+                    break
+                if not batch:
+                    first = time.time()
+                batch.append(item)
+                if len(batch) >= self.batch_size or time.time() - first > self.max_delay:
+                    self._put(out, batch, stats)
+                    batch = []
+            if batch:
+                self._put(out, batch, stats)
+            self._put(out, _end, stats)
+        except:
+            self._put(out, _Error(sys.exc_info()), stats)
+        finally:
+            stats.total += time.time() - start
+
+    def _put(self, q, item, stats):
+        stats.queued += q.qsize()
+        try:
+            q.put_nowait(item)
+        except Queue.Full:
+            t = time.time()
+            q.put(item)
+            stats.wait_output += time.time() - t
+        stats.n_batches += 1
+
+    def _iter_queue(self, q, stats, interruptible=False):
+        while not self._stopped:
+            try:
+                batch = q.get_nowait()
+            except Queue.Empty:
+                t = time.time()
+                if interruptible:
+                    # a blocking get() without timeout can not be
+                    # interrupted by Ctrl-C
+                    while True:
+                        try:
+                            batch = q.get(True, 3600)
+                            break
+                        except Queue.Empty:
+                            pass
+                else:
+                    batch = q.get()
+                stats.wait_input += time.time() - t
+            if batch is _end:
+                return
+            if type(batch) is _Error:
+                t, v, tb = batch.exc_info
+                raise t, v, tb
+            for item in batch:
+                yield item
+
+    def log_stats(self):
+        """Show how much of the time each stage has been busy, to find the
+        bottleneck.
+
+        """
+        for s in self.stats:
+            if not s.total:
+                continue
+            log.debug('stage %-9s busy %3.0f%%, waiting for input %3.0f%%, for output %3.0f%%, '
+                      'output queue %3.0f%% full on average', s.name, 100 * s.busy() / s.total,
+                      100 * s.wait_input / s.total, 100 * s.wait_output / s.total,
+                      100.0 * s.queued / s.n_batches / self.queue_size if s.n_batches else 0.0)
@@ -9,86 +9,246 @@
 """Scan mailboxes and analyze messages."""
 
 import re
+import sys
+import codecs
 import locale
 import os.path
 import collections
 import time
+import calendar
 import math
-import gzip
-import bz2
 import zlib
+import hashlib
+import cPickle
+import shelve
 import mailbox
 import email
 import email.utils
 import email.header
-import mmap
 
 import config
 import log
-from common import filter_any
+import mboxfile
+import mime
+import dirmailbox
+import compressed
+import spill
+import langid
+from anchored import AnchoredRegexp
+from common import filter_any, LRUCache
 
-guessLanguage = None
-def init_guess_language():
-    """Loads the guess_language module.
-    This takes 1-2 seconds, so it is delayed to increase responsiveness.
+language_model = None
+def init_language_model():
+    """Loads the trigram model for language guessing.
+    This only takes a few milliseconds, but is not needed if all bodies
+    are cached.
 
     """
-    global guessLanguage
-    if guessLanguage is not None:
+    global language_model
+    if language_model is not None:
         return
     try:
-        from guess_language import guessLanguage
-    except ImportError, e:
-        log.debug('failed to import guess_language, language guessing disabled: %s', e)
-        guessLanguage = lambda x: ''
+        language_model = langid.get_model()
+    except (IOError, ValueError), e:
+        log.warn('failed to load language model, language guessing disabled: %s', e)
+        language_model = False
+
+def rank_languages(sample):
+    """Return the ranking of the languages sample may be written in, see
+    langid.Model.rank().
+
+    """
+    init_language_model()
+    return language_model.rank(sample) if language_model else ''
+
+def add_language_ranking(d):
+    """Guess the language of the message of cache dictionary d from its
+    language sample, if it has been left to guess_recipient_languages()
+    but is guessed per message now. Returns True if d has been changed.
+
+    """
+    if language_per_recipient or d.get('language_ranking') is not None or \
+            not d.get('language_sample'):
+        return False
+    d['language_ranking'] = rank_languages(d['language_sample'])
+    d['language'] = langid.choose(d['language_ranking'], known_languages)
+    return True
 
 class MessageBody(object):
+    """Split a body into the unquoted text at the top, the attribution
+    (up to two lines) before the first quote, the unquoted text interleaved
+    with quotes and the unquoted text at the bottom, after the last quote.
+    Lines from a control message like "-----BEGIN PGP SIGNATURE-----" on
+    are ignored.
+
+    The lines are classified in one pass, top, attribution and bottom are
+    given as offsets into the body. unquoted and quoted only hold as many
+    of the non-empty unquoted and quoted lines as needed for the first
+    sample_words words of both. If bottom_needed is given, it is called with
+    the top, and if it returns False the classification stops as soon as
+    the posting style is known to be inline, and bottom is left empty.
+
+    """
     _re_control_message = re.compile(r'^-----.*-----$')
+    _re_word = re.compile(r'\w+')
+    sample_words = 20
 
-    def __init__(self, body, re_quote, re_smileys):
-        lines = body.split(u'\n')
-        top = []
-        attribution = []
-        interleaved = []
-        bottom = []
+    def __init__(self, body, re_quote, re_smileys, bottom_needed=None):
+        self.body = body
+        self.top_end = 0
+        self.attribution_start = self.attribution_end = 0
+        self.bottom_start = self.bottom_end = 0
+        # length of the unquoted lines after the first quote, joined
+        interleaved_length = -1
         unquoted = []
         quoted = []
+        n_unquoted_words = 0
+        n_quoted_words = 0
+        # (start, end) of the lines before the first quote
+        top = []
+        n_bottom = 0
         before_attribution = True
         following_quote = False
-        cur = top
-        for line in lines:
+        self.complete = True
+        start = 0
+        for line in body.split(u'\n'):
+            end = start + len(line)
             if self._re_control_message.match(line):
                 break
             elif re_quote.match(line) and not re_smileys.match(line):
                 if before_attribution:
                     # remove attribution (max: 2 lines)
-                    for i in range(2):
-                        if top and top[-1] != '':
-                            attribution.insert(0, top[-1])
-                            del top[-1]
-                            del unquoted[-1]
-                    cur = interleaved
+                    n = len(top)
+                    while n > 0 and len(top) - n < 2 and top[n-1][1] > top[n-1][0]:
+                        n -= 1
+                    if n < len(top):
+                        self.attribution_start = top[n][0]
+                        self.attribution_end = top[-1][1]
+                    self.top_end = top[n-1][1] if n > 0 else 0
+                    for line_start, line_end in top[:n]:
+                        if n_unquoted_words >= self.sample_words:
+                            break
+                        if line_end > line_start:
+                            unquoted.append(body[line_start:line_end])
+                            n_unquoted_words += len(self._re_word.findall(unquoted[-1]))
+                    top = None
                     before_attribution = False
-                del bottom[:]
+                    if bottom_needed is not None and not bottom_needed(self.top):
+                        bottom_needed = False
+                n_bottom = 0
                 following_quote = True
-                if line:
+                if line and n_quoted_words < self.sample_words:
                     quoted.append(line)
+                    n_quoted_words += len(self._re_word.findall(line))
             else:
                 if not following_quote:
-                    bottom.append(line)
+                    if not n_bottom:
+                        self.bottom_start = start
+                    self.bottom_end = end
+                    n_bottom += 1
                 following_quote = False
-                if line:
-                    unquoted.append(line)
-                cur.append(line)
-        if bottom:
-            del interleaved[-len(bottom):]
-        self.top = u'\n'.join(top)
-        self.attribution = u'\n'.join(attribution)
-        self.interleaved = u'\n'.join(interleaved)
-        self.bottom = u'\n'.join(bottom)
+                if before_attribution:
+                    top.append((start, end))
+                else:
+                    if line and n_unquoted_words < self.sample_words:
+                        unquoted.append(line)
+                        n_unquoted_words += len(self._re_word.findall(line))
+                    interleaved_length += len(line) + 1
+                    if bottom_needed is False and n_unquoted_words >= self.sample_words and \
+                            interleaved_length - 1 > self.top_end:
+                        # inline, whatever follows
+                        self.complete = False
+                        break
+            start = end + 1
+        if before_attribution:
+            # no quote, everything is top (and bottom)
+            if top:
+                self.top_end = top[-1][1]
+            for line_start, line_end in top:
+                if n_unquoted_words >= self.sample_words:
+                    break
+                if line_end > line_start:
+                    unquoted.append(body[line_start:line_end])
+                    n_unquoted_words += len(self._re_word.findall(unquoted[-1]))
+        if not n_bottom or not self.complete:
+            self.bottom_start = self.bottom_end = 0
+        bottom_length = self.bottom_end - self.bottom_start
+        if before_attribution:
+            interleaved_length = 0
+        elif n_bottom and self.complete:
+            # the bottom lines are not interleaved
+            interleaved_length -= bottom_length + 1
+        self.inline = not self.complete or \
+                max(interleaved_length, 0) + bottom_length > self.top_end
         self.unquoted = u'\n'.join(unquoted)
         self.quoted = u'\n'.join(quoted)
 
+    @property
+    def top(self):
+        return self.body[:self.top_end]
+
+    @property
+    def attribution(self):
+        return self.body[self.attribution_start:self.attribution_end]
+
+    @property
+    def bottom(self):
+        return self.body[self.bottom_start:self.bottom_end]
+
+# decoded From: and To: headers by raw header, and their addresses by
+# decoded header, which are repeated a lot in sent folders. With -j, they
+# are only used (and counted) in the worker processes.
+header_memo = LRUCache(1024)
+addresses_memo = LRUCache(1024)
+
+def get_addresses(field):
+    """Return (realname, email) of all addresses in the header field."""
+    addresses = addresses_memo.get(field)
+    if addresses is None:
+        addresses = tuple(email.utils.getaddresses([field]))
+        addresses_memo[field] = addresses
+    return addresses
+
+# the time the ages of all messages refer to, set by init()
+reference_time = time.time()
+
+def get_age(t):
+    """Return age in days of a message sent at time t."""
+    return int((reference_time - t) / 3600 / 24)
+
+# the usual format, e.g. "Mon, 1 May 2017 02:31:42 +0200 (CEST)"
+_re_date = re.compile(r'\s*(?:[A-Za-z]+,\s*)?(\d{1,2})\s+([A-Za-z]{3})\s+([1-9]\d{3})\s+'
+                      r'(\d{1,2}):(\d{1,2})(?::(\d{1,2}))?\s+([-+])(\d\d)(\d\d)(?:\s.*)?\Z', re.S)
+_months = dict((m, i + 1) for i, m in enumerate(['jan', 'feb', 'mar', 'apr', 'may', 'jun',
+                                                  'jul', 'aug', 'sep', 'oct', 'nov', 'dec']))
+# POSIX timestamp of the start of each (year, month) which has been seen
+_month_starts = {}
+
+def parse_date(s):
+    """Return time of the Date: header s, or None if it can not be
+    parsed. The same as email.utils.mktime_tz(email.utils.parsedate_tz(s)),
+    but much faster for the usual format.
+
+    """
+    m = _re_date.match(s)
+    if m:
+        day, month, year, hour, minute, second, sign, zone_hours, zone_minutes = m.groups()
+        month = _months.get(month.lower())
+        if month is not None:
+            start = _month_starts.get((year, month))
+            if start is None:
+                start = _month_starts[year, month] = calendar.timegm((int(year), month, 1, 0, 0, 0))
+            offset = int(zone_hours) * 3600 + int(zone_minutes) * 60
+            if sign == '-':
+                offset = -offset
+            # the same as calendar.timegm(), which does not check ranges
+            return start + (int(day) - 1) * 86400 + int(hour) * 3600 + int(minute) * 60 + \
+                    int(second or 0) - offset
+    date_tuple = email.utils.parsedate_tz(s)
+    if date_tuple:
+        return email.utils.mktime_tz(date_tuple)
+    return None
+
 class Message(object):
     def __init__(self):
         self.from_hdr = u''
@@ -103,14 +263,35 @@ class Message(object):
         self.greeting = u''
         self.goodbye = u''
         self.language = u''
+        # see langid.Model.rank(), None if the language has not been guessed
+        self.language_ranking = None
+        # unquoted words the language is guessed from
+        self.language_sample = u''
         self.body = u''
         self.posting_style = u'tofu'
+        # reason why the message can not be used
+        self.rejected = ''
 
         self.mbox_path = u''
 
+    def is_wanted(self, options, check_age=True):
+        """Check if the message passes the filters of options, which only
+        depend on the header, and unless check_age is False max_age.
+
+        """
+        if options['skip_multiple_recipients'] and len(self.to_emails) > 1:
+            return False
+        if options['exclude_mails_to_me'] and filter_any(config.is_this_me, self.to_emails):
+            return False
+        if options['only_include_mails_from_me'] and not config.is_this_me(self.from_email):
+            return False
+        if check_age and options['max_age'] >= 0 and self.age > options['max_age']:
+            return False
+        return True
+
     def set_time(self, t):
         self.time = t
-        self.age = int((time.time() - self.time) / 3600 / 24)
+        self.age = get_age(t)
 
     def from_dict(self, d):
         self.from_hdr = d['from_hdr']
@@ -123,7 +304,14 @@ class Message(object):
         self.signature = d['signature']
         self.greeting = d['greeting']
         self.goodbye = d['goodbye']
-        self.language = d['language']
+        # the ranking is missing in caches of older versions
+        self.language_ranking = d.get('language_ranking')
+        if self.language_ranking is not None:
+            self.language = langid.choose(self.language_ranking, known_languages)
+        else:
+            self.language = d['language']
+        # only collected by the recipients if needed
+        self.language_sample = d.get('language_sample', u'') if language_per_recipient else u''
         self.posting_style = d['posting_style']
     def from_dict_only(self, d):
         self.from_dict(d)
@@ -140,69 +328,156 @@ class Message(object):
         d['greeting'] = self.greeting
         d['goodbye'] = self.goodbye
         d['language'] = self.language
+        d['language_ranking'] = self.language_ranking
+        d['language_sample'] = self.language_sample
         d['posting_style'] = self.posting_style
 
 
 class MailboxMessage(Message):
     _re_msgid = re.compile(r'^Message-ID:[ \t]*(.*?)\n[^ \t]', re.M | re.I | re.S)
-    _re_signature = re.compile(r'\n-- \n(.*)$', re.DOTALL)
-    _re_greeting = re.compile(r'^(.{2,40})\n\n')
-    _re_goodbye = re.compile(r'\n\n((?:.{2,40}\n.{2,40})|(?:.{2,40}\n\n.{2,40})|(?:.{2,40}))$')
+    _signature_separator = u'\n-- \n'
+    _re_greeting = AnchoredRegexp(r'^(.{2,40})\n\n')
+    _re_goodbye = AnchoredRegexp(r'\n\n((?:.{2,40}\n.{2,40})|(?:.{2,40}\n\n.{2,40})|(?:.{2,40}))$')
     _re_quote = re.compile(r'^([ \t]*[|>:}#])+')
     _re_smileys = re.compile(r'(>From )|(:[-^]?[][)(><}{|/DP])')
     _assumed_charsets = ['us-ascii', 'iso-8859-1', 'utf-8']
 
-    def __init__(self, path, mbox, mbox_key, is_single_file=True):
+    def __init__(self, path, mbox, mbox_key, is_single_file=True, identity=None):
         super(MailboxMessage, self).__init__()
         self.mbox_path = path
         self.mbox = mbox
         self.mbox_key = mbox_key
         self.is_single_file = is_single_file
         self.identifier = ''
+        # raw message, read at most once
+        self.buf = None
 
         # for directory mailboxes like Maildir and MH
         self.path = ''
         self.mtime = -1
+        self.ino = -1
+        self.size = -1
 
-        # for file mailboxes like mbox, MMDF and Babyl
+        # for file mailboxes like mbox, MMDF and Babyl, the checksum of
+        # the whole message is only computed if the position (offset in the
+        # mailbox, length and checksum of the header) has changed
         self.msgid = ''
         self.adler32 = ''
+        self.offset = None
+        self.length = -1
+        self.header_adler32 = ''
+
+        if identity is None:
+            self.identify()
+        else:
+            self.identifier, self.msgid, self.adler32, self.offset, \
+                    self.length, self.header_adler32 = identity
+
+    def get_identity(self):
+        """Return identity of message in a file mailbox, which can be passed
+        to the constructor instead of identifying the message again.
+
+        """
+        return (self.identifier, self.msgid, self.adler32, self.offset,
+                self.length, self.header_adler32)
+
+    def get_position(self):
+        return self.offset, self.length, self.header_adler32
 
-        self.identify()
+    def update_position(self, d):
+        """Store position of the unchanged message in its cache dictionary d,
+        return True if it has been moved.
+
+        """
+        if self.is_single_file or self.offset is None:
+            return False
+        if d.get('position') == self.get_position():
+            return False
+        d['position'] = self.get_position()
+        return True
+
+    def get_adler32(self):
+        if self.adler32 == '':
+            self.adler32 = zlib.adler32(self.get_buffer())
+        return self.adler32
 
     def has_changed(self, d):
         if not self.is_single_file:
-            if d['adler32'] == self.adler32:
+            if self.offset is not None and d.get('position') == self.get_position():
                 return False
-            return True
+            return d['adler32'] != self.get_adler32()
         else:
-            msg_mtime = os.path.getmtime(self.path)
-            return msg_mtime > d['mtime']
+            # inode and size are not in caches of older versions
+            return self.mtime > d['mtime'] or \
+                    self.ino != d.get('ino', self.ino) or \
+                    self.size != d.get('size', self.size)
+
+    def __getstate__(self):
+        # the mailbox can not be pickled, so worker processes get a
+        # message which has been read in advance by get_string()
+        state = self.__dict__.copy()
+        state['mbox'] = None
+        return state
+
+    def get_buffer(self):
+        """Return raw message, without copying it if the mailbox allows."""
+        if self.buf is None and hasattr(self.mbox, 'get_buffer'):
+            self.buf = self.mbox.get_buffer(self.mbox_key)
+        return self.get_string() if self.buf is None else self.buf
+
+    def get_string(self):
+        if type(self.buf) is buffer:
+            self.buf = str(self.buf)
+        elif self.buf is None:
+            if self.mbox is not None:
+                self.buf = self.mbox.get_string(self.mbox_key)
+            else:
+                f = open(self.path, 'rb')
+                self.buf = f.read()
+                f.close()
+        return self.buf
 
     def identify(self):
         if not self.is_single_file:
-            buf = self.mbox.get_string(self.mbox_key)
-            msgid_match = self._re_msgid.search(buf)
+            buf = self.get_buffer()
+            header_end = mime.header_end(buf)
+            # the character after the header is needed by _re_msgid
+            msgid_match = self._re_msgid.search(buf, 0, header_end + 1)
+            if hasattr(self.mbox, 'get_offset'):
+                self.offset = self.mbox.get_offset(self.mbox_key)
+            self.length = len(buf)
+            self.header_adler32 = zlib.adler32(buf[:header_end])
             if msgid_match:
                 self.msgid = msgid_match.group(1).strip()
-                self.adler32 = zlib.adler32(buf)
                 self.identifier = '%s\0%s' % (self.mbox_path, self.msgid)
             else:
-                log.debug('message has no Message-ID, cannot cache: %s -> %s', self.mbox_path, self.mbox_key)
+                # identify by content, the key changes when messages
+                # before it are deleted
+                self.identifier = '%s\0%s' % (self.mbox_path, hashlib.sha1(buf).hexdigest())
         else:
-            f = self.mbox.get_file(self.mbox_key)
-            self.path = f._file.name
-            self.identifier = self.path
-            self.mtime = os.path.getmtime(self.path)
+            self.path, self.ino, self.size, self.mtime = self.mbox.get_info(self.mbox_key)
+            if self.mbox.type == 'Maildir':
+                # the file name changes with the flags and when moving
+                # from new/ to cur/, the key (unique name) does not
+                self.identifier = '%s\0%s' % (self.mbox_path, self.mbox_key)
+            else:
+                self.identifier = self.path
 
     def to_dict(self, d):
         super(MailboxMessage, self).to_dict(d)
         d['mbox_path'] = self.mbox_path
+        d['msgid'] = self.msgid
         d['mtime'] = self.mtime
-        d['adler32'] = self.adler32
+        d['ino'] = self.ino
+        d['size'] = self.size
+        d['adler32'] = self.get_adler32() if not self.is_single_file else ''
+        if self.offset is not None:
+            d['position'] = self.get_position()
 
     def from_dict(self, d):
         super(MailboxMessage, self).from_dict(d)
+        # not in caches of older versions
+        self.msgid = d.get('msgid', self.msgid)
         self.mtime = d['mtime']
         self.adler32 = d['adler32']
 
@@ -210,99 +485,120 @@ class MailboxMessage(Message):
         super(MailboxMessage, self).from_dict_only(d)
         self.mbox_path = d['mbox_path']
 
-    def try_unicode(self, s):
+    def decode_body(self, s, charset, truncated=False):
+        """Decode s, which may end with an incomplete character if it has
+        been truncated."""
+        if not truncated:
+            return unicode(s, charset) if charset else unicode(s)
+        decoder = codecs.getincrementaldecoder(charset or sys.getdefaultencoding())()
+        return decoder.decode(s)
+
+    def try_unicode(self, s, truncated=False):
         unicode_error = None
         for charset in ([None]+self._assumed_charsets):
-            try: u = unicode(s, charset) if charset else unicode(s)
+            try: u = self.decode_body(s, charset, truncated)
             except (UnicodeDecodeError, LookupError), e: unicode_error = e
             else:
                 return u, charset
         raise unicode_error
 
-    def decode_header_field(self, h, encodings_used=None):
+    def decode_header_field(self, h, encodings_used=None, memo=None):
         """Return unicode representation of header body, e.g.:
         '=?utf-8?b?ZMOpasOgIHZ1?=' -> u'déjà vu'
     
         throws UnicodeDecodeError
+
+        If memo is given, the result is looked up there first.
     
         """
-        lst = email.header.decode_header(h)
-        try:
-            h_dec = email.header.make_header(lst)
-        except UnicodeDecodeError, e:
-            lst[:] = [(s, self.try_unicode(s)[1]) for s, enc in lst]
+        result = memo.get(h) if memo is not None else None
+        if result is None:
+            lst = email.header.decode_header(h)
+            try:
+                h_dec = email.header.make_header(lst)
+            except UnicodeDecodeError, e:
+                lst[:] = [(s, self.try_unicode(s)[1]) for s, enc in lst]
 
-        h_dec = email.header.make_header(lst)
+            h_dec = email.header.make_header(lst)
+            result = unicode(h_dec), tuple(x[1] for x in lst if x[1])
+            if memo is not None:
+                memo[h] = result
 
         if encodings_used is not None:
-            for x in lst:
-                if x[1]:
-                    encodings_used.add(x[1])
+            encodings_used.update(result[1])
 
-        return unicode(h_dec)
+        return result[0]
+
+    def reject(self, reason):
+        """Remember and log why the message can not be used, return False."""
+        self.rejected = reason
+        log.debug('%s: %s', reason, self.identifier)
+        return False
 
     def parse_header(self):
-        msg = self.mbox.get_message(self.mbox_key)
+        msg, self.body_start = mime.parse_header(self.get_buffer())
         self.msg = msg
+        if not self.msgid and msg['Message-ID']:
+            # messages of directory mailboxes are identified without reading
+            self.msgid = msg['Message-ID'].strip()
 
         self.encodings_used = set()
         try:
-            self.from_hdr = self.decode_header_field(msg['From'], self.encodings_used)
+            self.from_hdr = self.decode_header_field(msg['From'], self.encodings_used, header_memo)
         except UnicodeDecodeError, e:
-            log.debug('can not decode From: header of %s: %s', self.identifier, str(e))
-            return False
+            return self.reject('can not decode From: header (%s)' % e)
 
         try:
-            to_hdr = self.decode_header_field(msg['To'], self.encodings_used)
+            to_hdr = self.decode_header_field(msg['To'], self.encodings_used, header_memo)
         except UnicodeDecodeError, e:
-            log.debug('can not decode To: header of %s: %s', self.identifier, str(e))
-            return False
+            return self.reject('can not decode To: header (%s)' % e)
 
+        # hardly ever repeated, not worth a memo
         date_str = self.decode_header_field(msg['Date'])
 
-        from_decoded = email.utils.getaddresses([self.from_hdr])
+        from_decoded = get_addresses(self.from_hdr)
         if not from_decoded or not from_decoded[0][1]:
-            log.debug('mail has no sender: %s', self.identifier)
-            return False
+            return self.reject('mail has no sender')
         self.from_email = from_decoded[0][1].lower()
         self.from_realname = from_decoded[0][0]
-        self.to_emails = set(e.lower() for n, e in email.utils.getaddresses([to_hdr]))
+        self.to_emails = set(e.lower() for n, e in get_addresses(to_hdr))
         if not self.to_emails:
-            log.debug('mail has no recipient: %s', self.identifier)
-            return False
+            return self.reject('mail has no recipient')
         self.to_emails_str = ' '.join(sorted(self.to_emails))
 
-        msg_time = time.time()
+        msg_time = None
         if date_str:
-            date_tuple = email.utils.parsedate_tz(date_str)
-            if date_tuple:
-                msg_time = email.utils.mktime_tz(date_tuple)
-        self.set_time(msg_time)
+            msg_time = parse_date(date_str)
+        self.set_time(msg_time if msg_time is not None else reference_time)
 
         return True
 
     def parse_body(self):
-        if self.msg.is_multipart():
-            for part in self.msg.walk():
-                if part.get_content_type() == 'text/plain':
-                    self.msg = part
-                    break
-            else:
+        global body_cache_hits
+        part = mime.find_text_part(self.msg, self.get_buffer(), self.body_start)
+        if part is None:
+            if self.msg.get_content_maintype() in ('multipart', 'message'):
                 log.debug('%s message contains no text/plain subpart: %s', self.msg.get_content_type(), self.identifier, v=2)
-                return False
-        if self.msg.get_content_type() != 'text/plain':
-            log.debug('content type %s not supported: %s', self.msg.get_content_type(), self.identifier, v=2)
+            else:
+                log.debug('content type %s not supported: %s', self.msg.get_content_type(), self.identifier, v=2)
             return False
+        self.msg = part
 
         self.charset = self.msg.get_content_charset('')
 
+        payload = self.msg.get_payload(decode=True)
+        truncated = 0 < max_body_size < len(payload)
+        if truncated:
+            log.debug('analyzing only %d of %d bytes of body: %s', max_body_size, len(payload), self.identifier, v=2)
+            payload = payload[:max_body_size]
+
         unicode_error = None
         if self.charset:
-            try: self.body = unicode(self.msg.get_payload(decode=True), self.charset)
+            try: self.body = self.decode_body(payload, self.charset, truncated)
             except (UnicodeDecodeError, LookupError), e: unicode_error = e
         else:
             try:
-                self.body, charset = self.try_unicode(self.msg.get_payload(decode=True))
+                self.body, charset = self.try_unicode(payload, truncated)
             except (UnicodeDecodeError, LookupError), e:
                  unicode_error = e
             else:
@@ -326,32 +622,70 @@ class MailboxMessage(Message):
         self.body = self.body.replace(u'\r\n', u'\n')
         self.body = self.body.strip(u'\n')
 
+        personalize = config.get('personalize_mailinglists') or \
+                not filter_any(config.is_mailinglist, self.to_emails)
+        if body_cache is None:
+            self.analyze_body(personalize)
+            return True
+        key = hashlib.sha1('%s\0%d\0%s' % (config_fingerprint, personalize,
+                                           self.body.encode('utf-8'))).hexdigest()
+        # new entries are passed on to the main process by worker processes
+        updates = body_cache if body_cache_updates is None else body_cache_updates
+        analysis = body_cache.get(key)
+        if analysis is not None:
+            body_cache_hits += 1
+            self.signature, self.greeting, self.goodbye, self.posting_style, \
+                    self.language_ranking, self.language_sample = analysis
+            if self.language_ranking is None and not language_per_recipient:
+                # analyzed when the language was guessed per recipient
+                self.language_ranking = rank_languages(self.language_sample)
+                updates[key] = analysis[:4] + (self.language_ranking, self.language_sample)
+            if self.language_ranking is not None:
+                self.language = langid.choose(self.language_ranking, known_languages)
+            return True
+        self.analyze_body(personalize)
+        updates[key] = (self.signature, self.greeting, self.goodbye,
+                        self.posting_style, self.language_ranking, self.language_sample)
+        return True
+
+    def analyze_body(self, personalize=True):
+        """Recognize signature, greeting, goodbye message, posting style and
+        language of the decoded body. Greeting and goodbye message are not
+        recognized if personalize is False.
+
+        """
         # start with signature detection because it is the easiest/safest
-        match = self._re_signature.search(self.body)
-        self.signature = match.group(1) if match else u''
+        i = self.body.find(self._signature_separator)
+        self.signature = self.body[i+len(self._signature_separator):] if i >= 0 else u''
         if self.signature:
-            self.body = self._re_signature.sub(u'', self.body, 1).rstrip('\n')
+            self.body = self.body[:i].rstrip('\n')
 
         match = self._re_greeting.search(self.body)
         self.greeting = match.group(1) if match else u''
 
         body = self.body
         if self.greeting:
-            body = self._re_greeting.sub(u'', body, 1).lstrip('\n')
+            body = self._re_greeting.sub_first(u'', body, match).lstrip('\n')
 
-        mb = MessageBody(body, self._re_quote, self._re_smileys)
+        # the bottom is only needed for a goodbye message, if there is
+        # none in the top
+        mb = MessageBody(body, self._re_quote, self._re_smileys,
+                         lambda top: personalize and not self._re_goodbye.search(top.rstrip('\n')))
 
-        if len(mb.interleaved) + len(mb.bottom) > len(mb.top):
+        if mb.inline:
             self.posting_style = u'inline'
 
-        init_guess_language()
-        words_to_guess = u' '.join(re.split(r'\W+', u'%s %s' % (mb.unquoted, mb.quoted))[:20])
-        guessed_language = guessLanguage(words_to_guess)
-        self.language = guessed_language if guessed_language != 'UNKNOWN' else ''
+        # also kept when guessing per message, so that the cached analysis
+        # does not depend on language_per_recipient
+        self.language_sample = u' '.join(re.split(r'\W+', u'%s %s' % (mb.unquoted, mb.quoted))[:mb.sample_words])
+        if not language_per_recipient:
+            # otherwise guessed by guess_recipient_languages()
+            self.language_ranking = rank_languages(self.language_sample)
+            self.language = langid.choose(self.language_ranking, known_languages)
 
-        if not config.get('personalize_mailinglists') and filter_any(config.is_mailinglist, self.to_emails):
+        if not personalize:
             self.greeting = u''
-            return True
+            return
 
         if not mb.unquoted:
             self.greeting = u''
@@ -360,11 +694,57 @@ class MailboxMessage(Message):
         if not match:
             match = self._re_goodbye.search(mb.bottom.rstrip('\n'))
         if match:
-            body = self._re_goodbye.sub(u'', body, 1).strip('\n')
+            body = self._re_goodbye.sub_first(u'', body).strip('\n')
             if body:
                 self.goodbye = match.group(1)
 
-        return True
+def analyze_message(msg):
+    """Parse header and body of msg and return its cache dictionary. Also
+    called in worker processes.
+
+    If the header could not be parsed, the dictionary contains the reason
+    as 'rejected'. The body of messages rejected by the filters is not
+    parsed, their dictionary is marked as 'header_only'.
+
+    """
+    d = {}
+    if not msg.parse_header():
+        msg.to_dict(d)
+        d['rejected'] = msg.rejected
+        return d
+    if filter_options is not None and not msg.is_wanted(filter_options):
+        d['header_only'] = True
+    else:
+        msg.parse_body()
+    msg.to_dict(d)
+    return d
+
+def init_worker(body_cache_path):
+    """Initialize a worker process of main.gen_recipients(), which reads
+    the body cache, but leaves writing it to the main process.
+
+    """
+    global body_cache, body_cache_updates
+    body_cache = shelve.open(body_cache_path, flag='r', protocol=2)
+    body_cache_updates = {}
+
+def analyze_message_in_worker(msg):
+    """Like analyze_message(), but return (d, updates, hits, memo_counts),
+    where updates is a list of the new (key, analysis) entries of the body
+    cache, hits the number of bodies whose analysis has been taken from it
+    and memo_counts the (hits, misses) of header_memo and addresses_memo.
+
+    """
+    global body_cache_hits
+    d = analyze_message(msg)
+    updates = body_cache_updates.items()
+    body_cache_updates.clear()
+    hits, body_cache_hits = body_cache_hits, 0
+    memo_counts = []
+    for memo in (header_memo, addresses_memo):
+        memo_counts.append((memo.hits, memo.misses))
+        memo.hits = memo.misses = 0
+    return d, updates, hits, memo_counts
 
 class Recipient(object):
     values = [
@@ -377,10 +757,14 @@ class Recipient(object):
         'goodbye',
         'charset',
         'language',
+        'language_sample',
         'mbox_path',
         'posting_style',
     ]
     weight_formula = compile('1.0 / math.sqrt(age + 1)', '<string>', 'eval')
+    # number of samples with the highest weight which are kept for
+    # guessing the language
+    max_language_samples = 8
     def __init__(self, emails, msg=None):
         self.emails = emails
         for v in self.values:
@@ -391,9 +775,33 @@ class Recipient(object):
         for v in self.values:
             getattr(self, v).clear()
     def add(self, msg):
-        incr_step = eval(self.weight_formula, {'age': msg.age, 'math': math})
-        for v in self.values:
-            getattr(self, v)[getattr(msg, v)] += incr_step
+        self.add_values(msg.age, [getattr(msg, v) for v in self.values])
+    def add_values(self, age, values):
+        """Count a message of age, whose attributes in self.values have
+        the given values.
+
+        """
+        incr_step = eval(self.weight_formula, {'age': age, 'math': math})
+        for v, value in zip(self.values, values):
+            getattr(self, v)[value] += incr_step
+        if len(self.language_sample) > 2 * self.max_language_samples:
+            samples = self.get_language_samples()
+            for sample in self.language_sample.keys():
+                if sample not in samples:
+                    del self.language_sample[sample]
+    def add_fcc(self, mbox_path, age):
+        """Count a copy of an added message, which is stored in mbox_path."""
+        self.mbox_path[mbox_path] += eval(self.weight_formula, {'age': age, 'math': math})
+    def get_language_samples(self):
+        """Return the non-empty language samples with the highest weight."""
+        samples = sorted((s for s in self.language_sample if s),
+                         key=lambda s: (-self.language_sample[s], s))
+        return samples[:self.max_language_samples]
+    def set_language(self, language):
+        """Count all messages as written in language."""
+        weight = sum(self.language.itervalues())
+        self.language.clear()
+        self.language[language] = weight
     def to_dict(self, d):
         d['emails'] = self.emails
         for v in self.values:
@@ -402,6 +810,116 @@ class Recipient(object):
         for v in self.values:
             setattr(self, v, collections.defaultdict(lambda: 0.0, d[v]))
 
+def guess_recipient_languages(recipients):
+    """Guess the language of each of recipients from its language samples,
+    all in one batch, whose rankings are looked up in language_cache first.
+
+    """
+    init_language_model()
+    texts = [u' '.join(r.get_language_samples()) for r in recipients]
+    keys = [hashlib.sha1('%s\0%s' % (config_fingerprint, text.encode('utf-8'))).hexdigest()
+            for text in texts]
+    rankings = [language_cache.get(key) if language_cache is not None else None
+                for key in keys]
+    missing = [i for i, ranking in enumerate(rankings) if ranking is None]
+    if missing and language_model:
+        ranked = language_model.rank_batch([texts[i] for i in missing])
+        for i, ranking in zip(missing, ranked):
+            rankings[i] = ranking
+            if language_cache is not None:
+                language_cache[keys[i]] = ranking
+    for r, ranking in zip(recipients, rankings):
+        r.set_language(langid.choose(ranking, known_languages) if ranking is not None else '')
+
+def with_guessed_languages(recipients, batch_size=64):
+    """Pass on recipients, whose languages are guessed in batches of
+    batch_size recipients.
+
+    """
+    batch = []
+    for r in recipients:
+        batch.append(r)
+        if len(batch) >= batch_size:
+            guess_recipient_languages(batch)
+            for r in batch:
+                yield r
+            batch = []
+    guess_recipient_languages(batch)
+    for r in batch:
+        yield r
+
+def output_order(key):
+    """Sort key for recipients, so that larger address groups are matched
+    later. Also comparison of output files is easier when debugging.
+
+    """
+    return len(key), key
+
+class Recipients(dict):
+    """Recipients by the string of their addresses."""
+    def add(self, msg):
+        if msg.to_emails_str not in self:
+            self[msg.to_emails_str] = Recipient(msg.to_emails, msg)
+        else:
+            self[msg.to_emails_str].add(msg)
+    def add_fcc(self, key, mbox_path, age):
+        self[key].add_fcc(mbox_path, age)
+    def in_output_order(self):
+        """Generate all recipients sorted by output_order()."""
+        recipients = (self[key] for key in sorted(self, key=output_order))
+        if language_per_recipient:
+            recipients = with_guessed_languages(recipients)
+        return recipients
+    def close(self):
+        pass
+
+class SpilledRecipients(object):
+    """Recipients, whose messages are not counted in memory, but written
+    to sorted runs in temporary files as soon as they take more than about
+    max_size bytes, and counted one recipient after the other when the
+    runs are merged in output order.
+
+    The values are summed up in the same order as by Recipients, so the
+    results are exactly the same.
+
+    """
+    def __init__(self, max_size):
+        self.runs = spill.SortedRuns(max_size)
+        self.n = 0
+    def _add(self, key, item):
+        self.n += 1
+        self.runs.add(output_order(key) + (self.n,), cPickle.dumps(item, 2))
+    def add(self, msg):
+        self._add(msg.to_emails_str, (msg.to_emails, msg.age,
+                                      [getattr(msg, v) for v in Recipient.values]))
+    def add_fcc(self, key, mbox_path, age):
+        self._add(key, (None, age, mbox_path))
+    def in_output_order(self):
+        """Generate all recipients sorted by output_order()."""
+        recipients = self._merge()
+        if language_per_recipient:
+            recipients = with_guessed_languages(recipients)
+        return recipients
+    def _merge(self):
+        r = None
+        r_key = None
+        for (n, key, i), data in self.runs:
+            emails, age, values = cPickle.loads(data)
+            if key != r_key:
+                if r is not None:
+                    yield r
+                # the first message of a recipient is never a copy
+                r = Recipient(emails)
+                r_key = key
+            if emails is None:
+                r.add_fcc(values, age)
+            else:
+                r.add_values(age, values)
+        if r is not None:
+            yield r
+    def close(self):
+        self.runs.close()
+
 class Mailbox(object):
     def __init__(self, path, type='auto'):
         if not os.path.exists(path):
@@ -410,16 +928,14 @@ class Mailbox(object):
         if type == 'auto':
             type = self.recognize()
         self.isdir = os.path.isdir(self.path)
-        if type == 'mbox':
-            self.mb = mailbox.mbox(path, create=False)
-            self.try_decompress()
-        elif type == 'Maildir':
-            self.mb = mailbox.Maildir(path, factory=None, create=False)
-        elif type == 'MH':
-            self.mb = mailbox.MH(path, create=False)
-        elif type == 'MMDF':
-            self.mb = mailbox.MMDF(path, create=False)
-            self.try_decompress()
+        # identities of mbox / MMDF messages by key, see get_state()
+        self.identities = {}
+        # if False, identities are not kept, to save memory
+        self.remember_identities = True
+        if type in ('mbox', 'MMDF'):
+            self.mb = mboxfile.MboxFile(path, type)
+        elif type in ('Maildir', 'MH'):
+            self.mb = dirmailbox.DirMailbox(self.path, type)
         elif type == 'Babyl':
             self.mb = mailbox.Babyl(path, create=False)
         else:
@@ -428,17 +944,71 @@ class Mailbox(object):
     def __len__(self):
         return len(self.mb)
 
-    def messages(self):
-        for k in self.mb.iterkeys():
-            yield MailboxMessage(self.path, self.mb, k, self.isdir)
+    def messages(self, newest_first=False):
+        """Generate messages, in the order of the mailbox or starting with
+        the newest, i.e. the last one in file mailboxes and the one with
+        the latest mtime in directory mailboxes.
+
+        """
+        if not newest_first:
+            keys = self.mb.iterkeys()
+        elif isinstance(self.mb, dirmailbox.DirMailbox):
+            keys = reversed(self.mb.keys_by_mtime())
+        else:
+            keys = reversed(list(self.mb.iterkeys()))
+        for k in keys:
+            msg = MailboxMessage(self.path, self.mb, k, self.isdir, self.identities.get(k))
+            if self.remember_identities and isinstance(self.mb, mboxfile.MboxFile):
+                self.identities[k] = msg.get_identity()
+            yield msg
 
-    def try_decompress(self):
-        if re.match(r'.*\.gz$', self.path):
-            self.mb._file.close()
-            self.mb._file = gzip.GzipFile(self.path)
-        elif re.match(r'.*\.bz2$', self.path):
-            self.mb._file.close()
-            self.mb._file = bz2.BZ2File(self.path)
+    def get_mtime(self):
+        """Return time of the last modification of the mailbox, for
+        Maildir folders of the newest of its directories.
+
+        """
+        paths = [self.path]
+        if self.isdir:
+            paths.extend(os.path.join(self.path, d) for d in ('cur', 'new'))
+        return max(os.stat(p).st_mtime for p in paths if os.path.exists(p))
+
+    def get_signature(self):
+        """Return value which changes whenever the mailbox is changed, or
+        None if this can not be determined reliably.
+
+        """
+        if isinstance(self.mb, dirmailbox.DirMailbox):
+            return self.mb.get_signature()
+        st = os.stat(self.path)
+        # a file changed within the mtime resolution could change again
+        # without a new mtime
+        if st.st_mtime > time.time() - 3:
+            return None
+        return st.st_size, st.st_mtime
+
+    def get_state(self):
+        """Return state which allows skipping unchanged messages in the next
+        run, or None if not supported for this mailbox.
+
+        """
+        if not hasattr(self.mb, 'get_state'):
+            return None
+        state = self.mb.get_state()
+        if state is not None and self.remember_identities and \
+                isinstance(self.mb, mboxfile.MboxFile):
+            state['identities'] = [self.identities.get(k) for k in xrange(len(self.mb))]
+        return state
+
+    def restore_state(self, state):
+        """Restore state of a previous run returned by get_state()."""
+        if not state or not hasattr(self.mb, 'restore'):
+            return
+        self.mb.restore(state)
+        if not self.remember_identities or 'identities' not in state:
+            return
+        for k in xrange(self.mb.n_unchanged):
+            if state['identities'][k] is not None:
+                self.identities[k] = state['identities'][k]
 
     def recognize(self):
         t = ''
@@ -449,21 +1019,69 @@ class Mailbox(object):
                 t = 'MH'
         elif os.path.isfile(self.path):
             try:
-                f = open(self.path, mode='rb')
-                map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
-                if map[:5] == 'BABYL':
+                if compressed.compression(self.path):
+                    f = compressed.DecompressedFile(self.path)
+                    try:
+                        head = f.read(0, 5)
+                    finally:
+                        f.close()
+                else:
+                    f = open(self.path, mode='rb')
+                    head = f.read(5)
+                    f.close()
+                if head == 'BABYL':
                     t = 'Babyl'
-                elif map[:5] == '\x01\x01\x01\x01\n':
+                elif head == '\x01\x01\x01\x01\n':
                     t = 'MMDF'
                 else:
                     t = 'mbox'
-                map.close()
-                f.close()
-            except (IOError, mmap.error), e:
+            except (IOError, zlib.error), e:
                 log.error('cannot open mailbox %s: %s', self.path, str(e))
         return t
 
+# maximum number of bytes of the body which is analyzed, set by init()
+max_body_size = 0
+# languages which can be guessed, None for all, set by init(). Only
+# applied when choosing from the ranking of the guessed languages, so
+# that the cached analysis does not depend on it.
+known_languages = None
+
+# cache of analyze_body() results by hash of the decoded body, set by
+# main.gen_recipients(), or by init_worker() in worker processes, where
+# it is read-only
+body_cache = None
+body_cache_hits = 0
+# new entries of body_cache, collected here instead if it is read-only
+body_cache_updates = None
+# hash of the configuration which affects analyze_body(), set by init()
+config_fingerprint = ''
+
+# guess the language per recipient instead of per message, set by init()
+language_per_recipient = False
+# cache of the language rankings of guess_recipient_languages() by hash
+# of the samples, set by main.main()
+language_cache = None
+
+# options for Message.is_wanted() in analyze_message(), set by init()
+filter_options = None
+# hash of the configuration which affects which messages pass the header
+# filters and what they contribute, set by init()
+filter_fingerprint = ''
+
 def init(options):
+    global filter_options, max_body_size, known_languages, config_fingerprint, filter_fingerprint
+    global language_per_recipient, reference_time
+    reference_time = time.time()
+    filter_options = options
+    max_body_size = options['max_body_size']
+    language_per_recipient = options['language_per_recipient']
+    if options['known_languages'] != u'*':
+        known_languages = frozenset(options['known_languages'].split(u':'))
+    config_fingerprint = hashlib.sha1(repr((config.cache_version, sorted((k, options[k])
+            for k in config.variables_used_in_scan)))).hexdigest()
+    filter_fingerprint = hashlib.sha1(repr((config_fingerprint,
+            sorted((k, options[k]) for k in config.variables_used_in_filters),
+            sorted((k, getattr(config.rc, k)) for k in config.members_used_in_filters)))).hexdigest()
     try:
         re_quote = re.compile(options['quote_regexp'])
         MailboxMessage._re_quote = re_quote
@@ -475,12 +1093,12 @@ def init(options):
     except re.error, e:
         log.error('smileys is invalid regexp: %s', e)
     try:
-        re_greeting = re.compile(options['greeting_regexp'])
+        re_greeting = AnchoredRegexp(options['greeting_regexp'])
         MailboxMessage._re_greeting = re_greeting
     except re.error, e:
         log.error('greeting_regexp is invalid regexp: %s', e)
     try:
-        re_goodbye = re.compile(options['goodbye_regexp'])
+        re_goodbye = AnchoredRegexp(options['goodbye_regexp'])
         MailboxMessage._re_goodbye = re_goodbye
     except re.error, e:
         log.error('goodbye_regexp is invalid regexp: %s', e)
@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Sort more data than fits into memory, by writing sorted runs to
+temporary files and merging them, and look up data by key in temporary
+files."""
+
+import os
+import heapq
+import shutil
+import shelve
+import hashlib
+import tempfile
+import threading
+import cPickle
+
+import log
+
+# estimated memory used for an item besides its data
+_item_overhead = 200
+
+def _merge(iterators):
+    """Generate the items of the sorted iterators in sorted order, like
+    heapq.merge() of Python 2.6."""
+    heap = []
+    for i, it in enumerate(iterators):
+        for item in it:
+            heap.append((item, i, it))
+            break
+    heapq.heapify(heap)
+    while heap:
+        item, i, it = heap[0]
+        yield item
+        for item in it:
+            heapq.heapreplace(heap, (item, i, it))
+            break
+        else:
+            heapq.heappop(heap)
+
+class SortedRuns(object):
+    """Collect (key, data) items, where data is a str, and iterate over
+    them sorted by key, keeping at most about max_size bytes in memory.
+
+    Keys have to be unique, e.g. by including a sequence number.
+
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = []
+        self._size = 0
+        # temporary file and number of items of each run
+        self._runs = []
+
+    def add(self, key, data):
+        self._items.append((key, data))
+        self._size += len(data) + _item_overhead
+        if self._size > self.max_size:
+            self._spill()
+
+    def _spill(self):
+        self._items.sort()
+        f = tempfile.TemporaryFile(prefix='muttlearn')
+        pickler = cPickle.Pickler(f, 2)
+        for item in self._items:
+            pickler.dump(item)
+            # items are not referenced twice, the memo would only grow
+            pickler.clear_memo()
+        log.debug('wrote sorted run of %d items to temporary file', len(self._items))
+        self._runs.append((f, len(self._items)))
+        self._items = []
+        self._size = 0
+
+    def _read_run(self, f, n):
+        f.seek(0)
+        unpickler = cPickle.Unpickler(f)
+        for i in xrange(n):
+            yield unpickler.load()
+
+    def __iter__(self):
+        """Generate all (key, data) items sorted by key."""
+        self._items.sort()
+        if not self._runs:
+            return iter(self._items)
+        runs = [self._read_run(f, n) for f, n in self._runs]
+        return _merge([iter(self._items)] + runs)
+
+    def close(self):
+        """Remove the temporary files."""
+        for f, n in self._runs:
+            f.close()
+        self._runs = []
+        self._items = []
+
+class SpilledMapping(object):
+    """Mapping of str keys, which is kept in a temporary shelve instead of
+    memory. Only the SHA-1 digests of the keys are stored. It can be read
+    and written by several threads at once.
+
+    """
+    def __init__(self):
+        self._dir = tempfile.mkdtemp(prefix='muttlearn')
+        self._shelf = shelve.open(os.path.join(self._dir, 'mapping'), flag='n', protocol=2)
+        self._lock = threading.Lock()
+
+    def _key(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).digest()
+
+    def __contains__(self, key):
+        key = self._key(key)
+        self._lock.acquire()
+        try:
+            return key in self._shelf
+        finally:
+            self._lock.release()
+
+    def __getitem__(self, key):
+        key = self._key(key)
+        self._lock.acquire()
+        try:
+            return self._shelf[key]
+        finally:
+            self._lock.release()
+
+    def __setitem__(self, key, value):
+        key = self._key(key)
+        self._lock.acquire()
+        try:
+            self._shelf[key] = value
+        finally:
+            self._lock.release()
+
+    def setdefault(self, key, default=None):
+        key = self._key(key)
+        self._lock.acquire()
+        try:
+            if key in self._shelf:
+                return self._shelf[key]
+            self._shelf[key] = default
+            return default
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Remove the temporary files."""
+        self._shelf.close()
+        shutil.rmtree(self._dir, ignore_errors=True)
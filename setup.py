@@ -35,6 +35,9 @@ setup(
         'Topic :: Utilities',
     ],
     packages=find_packages(exclude=['docs', 'tests']),
+    package_data={
+        'muttlearn': ['trigrams.dat'],
+    },
     entry_points={
         'console_scripts': [
             'muttlearn=muttlearn:main',
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Test that AnchoredRegexp finds the same matches as re.search() and
+re.sub(), whether it searches only at the start or the end or the whole
+string.
+
+Run from the top directory: python -m unittest discover -s tests
+
+"""
+
+import re
+import random
+import unittest
+
+from muttlearn.anchored import AnchoredRegexp
+
+# (pattern, flags, expected anchor)
+patterns = [
+    # the defaults of greeting_regexp and goodbye_regexp
+    (ur'^(.{2,40})\n\n', 0, 'start'),
+    (ur'\n\n((?:.{2,40}\n.{2,40})|(?:.{2,40}\n\n.{2,40})|(?:.{2,40}))$', 0, 'end'),
+    (r'\Aab+', 0, 'start'),
+    (r'^a|b$', 0, None),
+    (r'(?:^a)', 0, None),
+    (r'b{1,3}$', 0, 'end'),
+    (r'(a|bb|\n)c?$', 0, 'end'),
+    (r'a{2,5}\Z', 0, 'end'),
+    (r'\n\Z', 0, 'end'),
+    (r'(?<=a)b{0,3}$', 0, 'end'),
+    (r'(?<!\n)b+\n?$', 0, None),
+    (r'\bab?$', 0, 'end'),
+    (r'$', 0, 'end'),
+    (r'^', 0, 'start'),
+    (r'^$', 0, 'start'),
+    # unbounded, so searched in the whole string
+    (r'a.*$', 0, None),
+    (r'(?s)a.*b$', 0, None),
+    (r'b+\Z', 0, None),
+    # group references, which sre_parse can not bound
+    (r'(a|bb)\1$', 0, None),
+    (r'(a)?(?(1)b|c)$', 0, None),
+    # MULTILINE, where ^ and $ also match at line breaks
+    (r'^a+$', re.M, None),
+    (r'(?m)b\n?$', 0, None),
+    (r'(?m)^ab', 0, None),
+    # not anchored
+    (r'ab', 0, None),
+    (r'a(?=b)', 0, None),
+    (r'', 0, None),
+]
+
+def random_string(rnd):
+    return ''.join(rnd.choice('aab\n c') for i in xrange(rnd.randint(0, 12)))
+
+class AnchoredRegexpTest(unittest.TestCase):
+
+    def check(self, pattern, flags, string):
+        anchored = AnchoredRegexp(pattern, flags)
+        regexp = re.compile(pattern, flags)
+        expected = regexp.search(string)
+        match = anchored.search(string)
+        name = '%r in %r' % (pattern, string)
+        if expected is None:
+            self.assertEqual(match, None, name)
+        else:
+            self.assertNotEqual(match, None, name)
+            self.assertEqual(match.span(), expected.span(), name)
+            self.assertEqual(match.groups(), expected.groups(), name)
+        self.assertEqual(anchored.sub_first('X', string), regexp.sub('X', string, 1), name)
+        self.assertEqual(anchored.sub_first('X', string, match), regexp.sub('X', string, 1), name)
+
+    def test_anchor(self):
+        for pattern, flags, anchor in patterns:
+            self.assertEqual(AnchoredRegexp(pattern, flags).anchor, anchor, pattern)
+
+    def test_window(self):
+        # one more for $ before a trailing line break
+        self.assertEqual(AnchoredRegexp(r'b{1,3}$').window, 4)
+        self.assertEqual(AnchoredRegexp(r'b{1,3}\Z').window, 3)
+
+    def test_cases(self):
+        for pattern, flags, anchor in patterns:
+            for string in ['', '\n', 'a', 'ab', 'ab\n', 'abb\n\n', 'a\nb', 'a\n\nb',
+                           'bbbbbbbb', 'aaaaaa\n', 'cabab', 'a b\n', 'aa\n\nbb\ncc\n']:
+                self.check(pattern, flags, string)
+
+    def test_long(self):
+        greeting = u'Hi Anna,\n\n'
+        goodbye = u'\n\nCheers,\nJoe'
+        body = greeting + u'text\n\n' * 1000 + u'> quoted\n' * 1000 + goodbye
+        for pattern, flags, anchor in patterns[:2]:
+            self.check(pattern, flags, body)
+            self.check(pattern, flags, body + u'\n')
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for pattern, flags, anchor in patterns:
+            for i in xrange(300):
+                self.check(pattern, flags, random_string(rnd))
+
+if __name__ == '__main__':
+    unittest.main()
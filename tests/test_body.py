@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Test that the body analysis finds the same signature, greeting, goodbye
+message, posting style and language sample as the previous implementation,
+which classified all lines of the body and searched with re.
+
+Run from the top directory: python -m unittest discover -s tests
+
+"""
+
+import re
+import random
+import unittest
+
+from muttlearn import scan
+from muttlearn.anchored import AnchoredRegexp
+
+class OldMessageBody(object):
+    """MessageBody before it stopped early and kept offsets."""
+    _re_control_message = re.compile(r'^-----.*-----$')
+
+    def __init__(self, body, re_quote, re_smileys):
+        lines = body.split(u'\n')
+        top = []
+        attribution = []
+        interleaved = []
+        bottom = []
+        unquoted = []
+        quoted = []
+        before_attribution = True
+        following_quote = False
+        cur = top
+        for line in lines:
+            if self._re_control_message.match(line):
+                break
+            elif re_quote.match(line) and not re_smileys.match(line):
+                if before_attribution:
+                    # remove attribution (max: 2 lines)
+                    for i in range(2):
+                        if top and top[-1] != '':
+                            attribution.insert(0, top[-1])
+                            del top[-1]
+                            del unquoted[-1]
+                    cur = interleaved
+                    before_attribution = False
+                del bottom[:]
+                following_quote = True
+                if line:
+                    quoted.append(line)
+            else:
+                if not following_quote:
+                    bottom.append(line)
+                following_quote = False
+                if line:
+                    unquoted.append(line)
+                cur.append(line)
+        if bottom:
+            del interleaved[-len(bottom):]
+        self.top = u'\n'.join(top)
+        self.attribution = u'\n'.join(attribution)
+        self.interleaved = u'\n'.join(interleaved)
+        self.bottom = u'\n'.join(bottom)
+        self.unquoted = u'\n'.join(unquoted)
+        self.quoted = u'\n'.join(quoted)
+
+_re_signature = re.compile(r'\n-- \n(.*)$', re.DOTALL)
+
+def old_analyze_body(body, patterns, personalize=True):
+    """Return signature, greeting, goodbye, posting style and the words to
+    guess the language from, like analyze_body() did before.
+
+    """
+    re_quote, re_smileys, re_greeting, re_goodbye = [re.compile(p) for p in patterns]
+    greeting = goodbye = u''
+    posting_style = u'tofu'
+    match = _re_signature.search(body)
+    signature = match.group(1) if match else u''
+    if signature:
+        body = _re_signature.sub(u'', body, 1).rstrip('\n')
+
+    match = re_greeting.search(body)
+    greeting = match.group(1) if match else u''
+
+    if greeting:
+        body = re_greeting.sub(u'', body, 1).lstrip('\n')
+
+    mb = OldMessageBody(body, re_quote, re_smileys)
+
+    if len(mb.interleaved) + len(mb.bottom) > len(mb.top):
+        posting_style = u'inline'
+
+    words_to_guess = u' '.join(re.split(r'\W+', u'%s %s' % (mb.unquoted, mb.quoted))[:20])
+
+    if not personalize:
+        return signature, u'', goodbye, posting_style, words_to_guess
+
+    if not mb.unquoted:
+        greeting = u''
+
+    match = re_goodbye.search(mb.top.rstrip('\n'))
+    if not match:
+        match = re_goodbye.search(mb.bottom.rstrip('\n'))
+    if match:
+        body = re_goodbye.sub(u'', body, 1).strip('\n')
+        if body:
+            goodbye = match.group(1)
+    return signature, greeting, goodbye, posting_style, words_to_guess
+
+default_patterns = (r'^([ \t]*[|>:}#])+', r'(>From )|(:[-^]?[][)(><}{|/DP])',
+                    ur'^(.{2,40})\n\n',
+                    ur'\n\n((?:.{2,40}\n.{2,40})|(?:.{2,40}\n\n.{2,40})|(?:.{2,40}))$')
+
+other_patterns = [
+    default_patterns,
+    # not anchored, searched in the whole body
+    (r'^>+', r':-\)', ur'(?m)^(Hi \w+,)$', ur'(?:Cheers|Bye),?\n(.+)'),
+    # anchored at the end, but of unlimited width
+    (r'^\s*>', r'>From ', ur'^(Dear .*?)\n', ur'\n\n(Regards,\n.*)$'),
+    # \Z and a lookbehind
+    (r'^[>|]', r'(>From )|(:[-^]?[][)(><}{|/DP])', ur'^((?:Hi|Hello) .{2,20})\n+',
+     ur'(?<=\n)((?:Cheers|Bye),?(?:\n.{2,20})?)\Z'),
+]
+
+lines = [u'Hi Anna,', u'Hello Joe', u'Dear all', u'', u'', u'', u'text with some words',
+         u'ein deutscher Satz mit Wörtern', u'x', u'> quoted text', u'>> deeper', u'| pipe',
+         u': colon', u'>From joe', u':-) smile', u'  > indented', u'-- ', u'--', u'Cheers,',
+         u'Bye', u'Joe', u'Regards,', u'-----BEGIN PGP SIGNATURE-----',
+         u'-----BEGIN PGP SIGNED MESSAGE-----', u'Hash: SHA1', u'a' * 50,
+         u'On Monday, Anna wrote:', u'Joe wrote:']
+
+def random_body(rnd):
+    n = rnd.choice([0, 1, 2, 5, 10, 30])
+    body = u'\n'.join(rnd.choice(lines) for i in xrange(n))
+    if rnd.random() < 0.3:
+        body += u'\n'
+    return body
+
+class AnalyzeBodyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (scan.language_per_recipient, scan.MailboxMessage._re_quote,
+                      scan.MailboxMessage._re_smileys, scan.MailboxMessage._re_greeting,
+                      scan.MailboxMessage._re_goodbye)
+        # keep the words to guess from, instead of guessing the language
+        scan.language_per_recipient = True
+
+    def tearDown(self):
+        scan.language_per_recipient, scan.MailboxMessage._re_quote, \
+            scan.MailboxMessage._re_smileys, scan.MailboxMessage._re_greeting, \
+            scan.MailboxMessage._re_goodbye = self.saved
+
+    def set_patterns(self, patterns):
+        quote, smileys, greeting, goodbye = patterns
+        scan.MailboxMessage._re_quote = re.compile(quote)
+        scan.MailboxMessage._re_smileys = re.compile(smileys)
+        scan.MailboxMessage._re_greeting = AnchoredRegexp(greeting)
+        scan.MailboxMessage._re_goodbye = AnchoredRegexp(goodbye)
+
+    def check(self, body, patterns, personalize=True):
+        # without a mailbox to identify the message in
+        msg = scan.MailboxMessage.__new__(scan.MailboxMessage)
+        scan.Message.__init__(msg)
+        msg.body = body
+        msg.analyze_body(personalize)
+        self.assertEqual((msg.signature, msg.greeting, msg.goodbye, msg.posting_style,
+                          msg.language_sample),
+                         old_analyze_body(body, patterns, personalize), repr(body))
+
+    def test_cases(self):
+        self.set_patterns(default_patterns)
+        for body in [u'', u'\n', u'Hi Anna,\n\ntext\n\nCheers,\nJoe\n-- \nJoe Test',
+                     u'Hi,\n\nAnna wrote:\n> question\nanswer\n> question\nanswer\n\nBye',
+                     u'answer\n\nBye\n\nAnna wrote:\n> question\n> more',
+                     u'text\n-----BEGIN PGP SIGNATURE-----\n> not quoted\n',
+                     u' '.join([u'word'] * 50) + u'\n> quote\n' + u'\n'.join([u'w'] * 30)]:
+            self.check(body, default_patterns)
+            self.check(body, default_patterns, False)
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for patterns in other_patterns:
+            self.set_patterns(patterns)
+            for i in xrange(1500):
+                self.check(random_body(rnd), patterns, rnd.random() < 0.8)
+
+if __name__ == '__main__':
+    unittest.main()
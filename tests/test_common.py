@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Test that LRUCache keeps the most recently used items.
+
+Run from the top directory: python -m unittest discover -s tests
+
+"""
+
+import random
+import unittest
+
+from muttlearn.common import LRUCache
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for max_size in [1, 2, 5]:
+            cache = LRUCache(max_size)
+            # (key, value), the most recently used last
+            expected = []
+            for i in xrange(2000):
+                key = rnd.randint(0, 8)
+                keys = [k for k, v in expected]
+                if rnd.random() < 0.5:
+                    value = cache.get(key)
+                    if key in keys:
+                        item = expected.pop(keys.index(key))
+                        self.assertEqual(value, item[1])
+                        expected.append(item)
+                    else:
+                        self.assertEqual(value, None)
+                else:
+                    if key in keys:
+                        del expected[keys.index(key)]
+                    expected.append((key, i))
+                    cache[key] = i
+                    del expected[:-max_size]
+                self.assertEqual(len(cache), len(expected))
+
+    def test_hit_rate(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.hit_rate(), 0.0)
+        cache['a'] = 1
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b', 2), 2)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.hit_rate(), 50.0)
+
+if __name__ == '__main__':
+    unittest.main()
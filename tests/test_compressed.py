@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Test that compressed returns the same data as the gzip and bz2 modules,
+also when decompressing in parallel.
+
+Run from the top directory: python -m unittest discover -s tests
+
+"""
+
+import os
+import bz2
+import gzip
+import random
+import shutil
+import tempfile
+import unittest
+import cStringIO
+
+from muttlearn import compressed
+
+def random_text(rnd, size):
+    """Return size bytes of text, which compresses about as well as mail."""
+    words = ['From', 'joe@test', 'Subject:', 'hello', 'world', 'the', 'a', 'of',
+             'muttlearn', 'mailbox', '\n', '\n\n', '>']
+    words.extend(''.join(chr(rnd.randint(97, 122)) for i in xrange(6)) for j in xrange(200))
+    parts = []
+    n = 0
+    while n < size:
+        w = rnd.choice(words)
+        parts.append(w + ' ')
+        n += len(w) + 1
+    return ''.join(parts)[:size]
+
+def gzip_data(data):
+    buf = cStringIO.StringIO()
+    f = gzip.GzipFile(fileobj=buf, mode='wb')
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+class CompressedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='muttlearn-test')
+        self.rnd = random.Random(1)
+        # small enough to have many chunks and restart points
+        self.saved = (compressed.chunk_size, compressed.checkpoint_interval,
+                      compressed.resume_interval, compressed.segment_size, compressed.jobs)
+        compressed.chunk_size = 1 << 10
+        compressed.checkpoint_interval = 1 << 12
+        compressed.resume_interval = 1 << 13
+        compressed.segment_size = 1 << 12
+
+    def tearDown(self):
+        compressed.chunk_size, compressed.checkpoint_interval, \
+            compressed.resume_interval, compressed.segment_size, compressed.jobs = self.saved
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        path = os.path.join(self.dir, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def check_reads(self, path, expected, n=200):
+        """Check sequential, backward and random reads of path."""
+        f = compressed.DecompressedFile(path)
+        self.assertEqual(f.read(0, len(expected) + 10), expected)
+        ranges = [(0, 0), (len(expected), len(expected) + 1)]
+        for i in xrange(n):
+            start = self.rnd.randint(0, len(expected))
+            ranges.append((start, start + self.rnd.randint(0, 3000)))
+        for start, stop in ranges:
+            self.assertEqual(f.read(start, stop), expected[start:stop], (start, stop))
+        return f
+
+    def check_mmap(self, path, expected):
+        f = compressed.DecompressedFile(path)
+        self.assertEqual(f.mmap()[:], expected)
+        self.assertEqual(f.size, len(expected))
+        return f
+
+    def test_gzip(self):
+        data = random_text(self.rnd, 100000)
+        path = self.write('single.gz', gzip_data(data))
+        self.assertEqual(gzip.open(path).read(), data)
+        f = self.check_reads(path, data)
+        # restart points within the single member
+        self.assertEqual(f.checkpoints, [(0, 0)])
+        self.assertTrue(len(f._states) > 5)
+        cpos, upos, state = f._restart_point(len(data) - 1)
+        self.assertTrue(upos > len(data) - 2 * compressed.resume_interval)
+        self.check_mmap(path, data)
+
+    def test_gzip_members(self):
+        parts = [random_text(self.rnd, self.rnd.randint(0, 20000)) for i in xrange(8)]
+        path = self.write('members.gz', ''.join(gzip_data(p) for p in parts))
+        data = gzip.open(path).read()
+        self.assertEqual(data, ''.join(parts))
+        f = self.check_reads(path, data)
+        self.assertTrue(len(f.checkpoints) > 1)
+        f = self.check_mmap(path, data)
+        restored = compressed.DecompressedFile(path)
+        restored.restore(f.get_state())
+        self.assertEqual(restored.checkpoints, f.checkpoints)
+        self.check_reads(path, data)
+
+    def test_gzip_padding(self):
+        data = random_text(self.rnd, 5000)
+        path = self.write('padded.gz', gzip_data(data) + gzip_data(data) + '\0' * 100)
+        self.check_reads(path, data + data)
+        self.check_mmap(path, data + data)
+
+    def test_bz2(self):
+        data = random_text(self.rnd, 50000)
+        path = self.write('single.bz2', bz2.compress(data))
+        self.check_reads(path, data, n=20)
+        self.check_mmap(path, data)
+
+    def test_bz2_streams(self):
+        # the bz2 module only reads the first stream
+        parts = [random_text(self.rnd, self.rnd.randint(0, 20000)) for i in xrange(6)]
+        path = self.write('streams.bz2', ''.join(bz2.compress(p) for p in parts))
+        data = ''.join(parts)
+        f = self.check_reads(path, data, n=50)
+        self.assertTrue(len(f.checkpoints) > 1)
+        self.check_mmap(path, data)
+
+    def test_empty(self):
+        for name, data in [('empty.gz', ''), ('empty.bz2', ''),
+                           ('nothing.gz', gzip_data('')), ('nothing.bz2', bz2.compress(''))]:
+            path = self.write(name, data)
+            f = compressed.DecompressedFile(path)
+            self.assertEqual(f.read(0, 10), '')
+            self.assertEqual(f.mmap(), '')
+            self.assertEqual(f.size, 0)
+
+    def test_close(self):
+        path = self.write('mbox.gz', gzip_data('From joe@test\n\nhello\n'))
+        f = compressed.DecompressedFile(path)
+        self.assertEqual(f.read(0, 5), 'From ')
+        f.close()
+        self.assertTrue(f._file.closed)
+        f = self.check_mmap(path, 'From joe@test\n\nhello\n')
+        f.close()
+        self.assertTrue(f._file.closed)
+        self.assertEqual(f._map, None)
+
+class ParallelTest(CompressedTest):
+    """Decompress segments in worker processes."""
+
+    def setUp(self):
+        CompressedTest.setUp(self)
+        compressed.jobs = 3
+
+    def test_gzip_segments(self):
+        parts = [random_text(self.rnd, self.rnd.randint(0, 20000)) for i in xrange(8)]
+        path = self.write('members.gz', ''.join(gzip_data(p) for p in parts))
+        data = ''.join(parts)
+        f = self.check_mmap(path, data)
+        self.assertTrue(len(f.checkpoints) > 1)
+        self.check_reads(path, data)
+
+    def test_gzip_false_magic(self):
+        # a stored member which contains the gzip magic number, which is
+        # found as segment start, so that decompression falls back
+        parts = [random_text(self.rnd, 10000), compressed._gz_magic * 3000,
+                 random_text(self.rnd, 10000)]
+        buf = cStringIO.StringIO()
+        for p in parts:
+            f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=0)
+            f.write(p)
+            f.close()
+        path = self.write('magic.gz', buf.getvalue())
+        self.check_mmap(path, ''.join(parts))
+
+    def test_bz2_blocks(self):
+        # blocks of 100 KB, of a single stream
+        data = random_text(self.rnd, 500000)
+        path = self.write('blocks.bz2', bz2.compress(data, 1))
+        f = open(path, 'rb')
+        segments = compressed._find_segments(f.read(), 'bz2')
+        f.close()
+        self.assertTrue(len(segments) > 3)
+        self.assertEqual([is_member for cpos, is_member, task in segments],
+                         [True] + [False] * (len(segments) - 1))
+        f = self.check_mmap(path, data)
+        self.assertEqual(f.checkpoints, [(0, 0)])
+
+    def test_bz2_streams_and_blocks(self):
+        parts = [random_text(self.rnd, self.rnd.randint(0, 250000)) for i in xrange(4)]
+        path = self.write('streams.bz2', ''.join(bz2.compress(p, 1) for p in parts))
+        f = self.check_mmap(path, ''.join(parts))
+        self.assertTrue(len(f.checkpoints) > 1)
+
+    def test_bz2_trailing_garbage(self):
+        data = random_text(self.rnd, 150000)
+        path = self.write('garbage.bz2', bz2.compress(data, 1) + 'garbage')
+        self.check_mmap(path, data)
+
+if __name__ == '__main__':
+    unittest.main()
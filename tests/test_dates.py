@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Test that scan.parse_date returns the same times as email.utils.
+
+Run from the top directory: python -m unittest discover -s tests
+
+"""
+
+import random
+import unittest
+import email.utils
+
+from muttlearn import scan
+
+def old_parse_date(s):
+    date_tuple = email.utils.parsedate_tz(s)
+    if date_tuple:
+        return email.utils.mktime_tz(date_tuple)
+    return None
+
+def outcome(parse, s):
+    """Return result of parse(s), or the class of the exception it raises,
+    like the email package does for years out of range or blank strings.
+
+    """
+    try:
+        return parse(s)
+    except Exception, e:
+        return e.__class__
+
+cases = [
+    'Mon, 1 May 2017 02:31:42 +0200 (CEST)',
+    'Mon, 1 May 2017 02:31:42 +0200',
+    '1 May 2017 02:31:42 +0200',
+    'Mon,1 May 2017 02:31:42 +0200',
+    '  Mon, 01 May 2017 2:3:4 -0930',
+    'Mon, 1 May 2017 02:31 +0200',
+    'Mon, 1 may 2017 02:31:42 +0200',
+    'Mon, 1 MAY 2017 02:31:42 +0200',
+    'Mon, 1 May 2017 02:31:42 -0000',
+    'Mon, 1 May 2017 02:31:42 +0200\n',
+    'Mon, 1 May 2017 02:31:42\t+0200\t(CEST)',
+    # obsolete zones
+    'Mon, 1 May 2017 02:31:42 GMT',
+    'Mon, 1 May 2017 02:31:42 UT',
+    'Mon, 1 May 2017 02:31:42 UTC',
+    'Mon, 1 May 2017 02:31:42 EST',
+    'Mon, 1 May 2017 02:31:42 PDT',
+    'Mon, 1 May 2017 02:31:42 Z',
+    'Mon, 1 May 2017 02:31:42 A',
+    'Mon, 1 May 2017 02:31:42 +02',
+    'Mon, 1 May 2017 02:31:42 +020',
+    'Mon, 1 May 2017 02:31:42 0200',
+    # years
+    'Mon, 1 May 17 02:31:42 +0200',
+    'Mon, 1 May 99 02:31:42 +0200',
+    'Mon, 1 May 69 02:31:42 +0200',
+    'Mon, 1 May 117 02:31:42 +0200',
+    'Mon, 1 May 0999 02:31:42 +0200',
+    'Mon, 1 May 10000 02:31:42 +0200',
+    # other orders and formats
+    'Mon May  1 02:31:42 2017',
+    'Mon, May 1 2017 02:31:42 +0200',
+    '2017-05-01 02:31:42 +0200',
+    'Mon, 1 May 2017 02.31.42 +0200',
+    'Mon, 1 May 2017 02:31:42 AM +0200',
+    # out of range
+    'Mon, 31 Feb 2017 02:31:42 +0200',
+    'Mon, 0 May 2017 02:31:42 +0200',
+    'Mon, 1 May 2017 25:61:61 +0200',
+    'Mon, 1 May 2017 02:31:42 +9999',
+    # garbage
+    '', ' ', 'garbage', 'Mon, 1 Mai 2017 02:31:42 +0200', 'Mon, 1 May', '1 May 2017',
+    'Mon, 1 May 2017 02:31:42 +0200 garbage', 'Mon, 1 May 2017 02:31:42 +0200x',
+    'Mon, 1 May 2017 x 02:31:42 +0200', 'Mon, 1 May 2017 02:31:42 +02:00',
+    'Mon, 1 May 2017 02:31:42 +0200\xff', '\xe4 1 May 2017 02:31:42 +0200',
+]
+
+weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+zones = ['+0000', '-0000', '+0200', '-0800', '+0530', '+1400', 'GMT', 'EST', 'CEST', '']
+
+def random_date(rnd):
+    """Return random Date: header, mostly in the usual format."""
+    parts = []
+    if rnd.random() < 0.8:
+        parts.append(rnd.choice(weekdays) + rnd.choice([',', ', ', ' ']))
+    parts.append('%d ' % rnd.randint(0, 32) if rnd.random() < 0.5 else
+                 '%02d ' % rnd.randint(0, 32))
+    parts.append(rnd.choice(months + ['jan', 'DEC', 'Foo']) + ' ')
+    parts.append(str(rnd.choice([rnd.randint(1970, 2038), rnd.randint(0, 99),
+                                 rnd.randint(1000, 9999)])) + ' ')
+    parts.append('%02d:%02d' % (rnd.randint(0, 24), rnd.randint(0, 60)))
+    if rnd.random() < 0.8:
+        parts.append(':%02d' % rnd.randint(0, 61))
+    parts.append(' ' + rnd.choice(zones))
+    if rnd.random() < 0.2:
+        parts.append(rnd.choice([' (CEST)', ' (UTC)', '\n', '  ', ' x']))
+    return ''.join(parts)
+
+class ParseDateTest(unittest.TestCase):
+
+    def test_cases(self):
+        for s in cases:
+            self.assertEqual(outcome(scan.parse_date, s), outcome(old_parse_date, s), s)
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for i in xrange(20000):
+            s = random_date(rnd)
+            self.assertEqual(outcome(scan.parse_date, s), outcome(old_parse_date, s), s)
+
+if __name__ == '__main__':
+    unittest.main()
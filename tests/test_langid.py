@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Test that langid guesses the same languages as guess_language, also when
+restricted to the known languages, and that language guessing is disabled
+without a model file.
+
+Run from the top directory: python -m unittest discover -s tests
+
+"""
+
+import os
+import sys
+import random
+import codecs
+import unittest
+
+from muttlearn import langid, scan
+
+try:
+    import guess_language
+    guess_language_module = sys.modules['guess_language.guess_language']
+except ImportError:
+    guess_language = None
+
+samples = [
+    u'This is a test of the language checker',
+    u'Verifions que le détecteur de langues marche',
+    u'Sprawdźmy, czy odgadywacz języków pracuje',
+    u'авай проверить  узнает ли наш угадатель русски язык',
+    u'La respuesta de los acreedores a la oferta argentina para salir del default no ha sido muy positiv',
+    u'Сайлау нәтижесінде дауыстардың басым бөлігін ел премьер министрі Виктор Янукович',
+    u'yakın tarihin en çekişmeli başkanlık seçiminde oy verme işlemi sürerken',
+    u'ملايين الناخبين الأمريكيين يدلون بأصواتهم وسط إقبال قياسي على انتخابات',
+    u'Os candidatos à presidência fizeram campanha até o último minuto ontem',
+    u'Ein deutscher Satz über Größe und Übermut',
+    u'Ελληνικά κείμενα', u'한국어 텍스트', u'カタカナ', u'中文文本', u'Tiếng Việt có dấu',
+    u'ção ções ão ã é á à ês não',
+    u'ab', u'', u'1234 !!', u'short',
+]
+
+def trigram_texts(rnd, n):
+    """Return n random texts made of the most frequent trigrams of one or
+    two languages of guess_language.
+
+    """
+    trigrams_dir = os.path.join(os.path.dirname(guess_language_module.__file__), 'trigrams')
+    trigrams = {}
+    for language in os.listdir(trigrams_dir):
+        path = os.path.join(trigrams_dir, language)
+        if not os.path.isdir(path):
+            trigrams[language] = [line[:3] for line in codecs.open(path, 'r', 'utf-8')][:100]
+    languages = sorted(trigrams)
+    texts = []
+    for i in xrange(n):
+        mixed = trigrams[rnd.choice(languages)] + \
+                (trigrams[rnd.choice(languages)] if rnd.random() < 0.3 else [])
+        texts.append(u' '.join(rnd.choice(mixed) for j in xrange(rnd.randint(0, 30))))
+    return texts
+
+class GuessLanguageTest(unittest.TestCase):
+
+    def setUp(self):
+        if guess_language is None:
+            self.skipTest('guess_language is not installed')
+        self.model = langid.get_model()
+        self.models = guess_language_module.models
+
+    def tearDown(self):
+        if guess_language is not None:
+            guess_language_module.models = self.models
+
+    def guess(self, text, known=None):
+        """Return the language guessed by guess_language, out of known."""
+        if known is not None:
+            # the languages without a model are not compared
+            guess_language_module.models = dict((l, m) for l, m in self.models.iteritems()
+                                                if langid.is_known(l, known) or
+                                                langid.is_known(l.replace('_br', '_BR').replace('_pt', '_PT'), known))
+        try:
+            language = guess_language.guessLanguage(text)
+        finally:
+            guess_language_module.models = self.models
+        return language if language != 'UNKNOWN' else ''
+
+    def test_samples(self):
+        for text in samples:
+            self.assertEqual(self.model.identify(text), self.guess(text), text)
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for text in trigram_texts(rnd, 500):
+            self.assertEqual(self.model.identify(text), self.guess(text), text)
+
+    def test_known(self):
+        rnd = random.Random(2)
+        languages = self.model.languages + ['ko', 'vi', 'xx']
+        texts = samples + trigram_texts(rnd, 300)
+        for i in xrange(100):
+            known = frozenset(rnd.sample(languages, rnd.randint(0, 10)))
+            if 'pt' in known and not known.intersection(langid._portuguese):
+                # Portuguese without its variants, see test_portuguese()
+                continue
+            for text in rnd.sample(texts, 20):
+                ranking = self.model.rank(text)
+                self.assertEqual(langid.choose(ranking, known), self.guess(text, known),
+                                 (text, known))
+
+    def test_portuguese(self):
+        # Portuguese is only refined for texts with non-ASCII letters
+        ranking = (('pt_PT', 'pt_BR'), 'es', 'it')
+        self.assertEqual(langid.choose(ranking), 'pt_PT')
+        self.assertEqual(langid.choose(ranking, frozenset(['pt', 'it'])), 'pt')
+        self.assertEqual(langid.choose(ranking, frozenset(['pt_BR', 'it'])), 'pt_BR')
+        self.assertEqual(langid.choose(ranking, frozenset(['it'])), 'it')
+        self.assertEqual(langid.choose(('en', 'pt'), frozenset(['pt_BR'])), 'pt')
+        text = u'ção ções ão ã é á à ês não'
+        ranking = self.model.rank(text)
+        self.assertEqual(ranking[0], ('pt_PT', 'pt_BR'))
+        self.assertEqual(langid.choose(ranking), self.guess(text))
+        self.assertEqual(langid.choose(ranking, frozenset(['pt_BR'])), 'pt_BR')
+
+class MissingModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = (langid.model_path, langid._model, scan.language_model,
+                      scan.language_per_recipient)
+        langid.model_path = os.path.join(os.path.dirname(__file__), 'missing.dat')
+        langid._model = None
+        scan.language_model = None
+        scan.language_per_recipient = False
+
+    def tearDown(self):
+        langid.model_path, langid._model, scan.language_model, \
+            scan.language_per_recipient = self.saved
+
+    def test_missing(self):
+        self.assertRaises(IOError, langid.Model, langid.model_path)
+        msg = scan.MailboxMessage.__new__(scan.MailboxMessage)
+        scan.Message.__init__(msg)
+        msg.body = samples[0]
+        msg.analyze_body()
+        self.assertEqual(scan.language_model, False)
+        self.assertEqual(msg.language, '')
+        self.assertEqual(msg.language_ranking, '')
+
+if __name__ == '__main__':
+    unittest.main()
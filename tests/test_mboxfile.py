@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Test that the message boundaries found by mboxfile are the same as the
+ones of mailbox.mbox and mailbox.MMDF.
+
+Run from the top directory: python -m unittest discover -s tests
+
+"""
+
+import os
+import time
+import random
+import shutil
+import tempfile
+import unittest
+import mailbox
+
+from muttlearn import mboxfile
+
+header = 'From: joe@test\nTo: anna@test\nSubject: test\n\n'
+
+mbox_cases = {
+    'empty': '',
+    'single': 'From joe@test Mon Jan  2 15:04:05 2006\n' + header + 'body\n',
+    'missing final newline': 'From joe@test Mon Jan  2 15:04:05 2006\n' + header + 'body',
+    'two': 'From a\n' + header + 'one\n\nFrom b\n' + header + 'two\n',
+    'no empty line before From': 'From a\n' + header + 'one\nFrom b\n' + header + 'two\n',
+    'From inside body': 'From a\n' + header + 'From the start\nfoo From bar\n>From quoted\n',
+    'garbage before first message': 'garbage\n\nFrom a\n' + header + 'one\n',
+    'only a From line': 'From a',
+    'empty lines at the end': 'From a\n' + header + 'one\n\n\n',
+    'empty message': 'From a\n\nFrom b\n',
+    'CRLF': 'From a\r\n' + header.replace('\n', '\r\n') + 'one\r\n\r\nFrom b\r\n',
+}
+
+sep = '\x01\x01\x01\x01\n'
+mmdf_cases = {
+    'empty': '',
+    'single': sep + header + 'body\n' + sep,
+    'two': sep + header + 'one\n' + sep + sep + header + 'two\n' + sep,
+    'missing final separator': sep + header + 'one\n' + sep + sep + header + 'two\n',
+    'missing final newline': sep + header + 'one',
+    'garbage between messages': sep + header + 'one\n' + sep + 'garbage\n' + sep + 'two\n' + sep,
+    'From inside body': sep + 'From a\n' + header + 'From the start\n' + sep,
+}
+
+def random_mbox(rnd, n):
+    """Return random mbox data with n messages, with lines which are likely
+    to be confused with message boundaries.
+
+    """
+    lines = ['From joe@test', 'From ', 'From', '', '>From x', ' From x', 'Subject: From',
+             'body', sep[:-1], '\r']
+    parts = []
+    for i in xrange(n):
+        if rnd.random() < 0.9:
+            parts.append('From joe@test Mon Jan  2 15:04:05 2006\n')
+        parts.extend(rnd.choice(lines) + '\n' for j in xrange(rnd.randint(0, 6)))
+        if rnd.random() < 0.5:
+            parts.append('\n')
+    data = ''.join(parts)
+    if data and rnd.random() < 0.3:
+        data = data[:-1]
+    return data
+
+def random_mmdf(rnd, n):
+    """Return random MMDF data with n messages."""
+    lines = [sep[:-1], sep[:-1] + 'x', 'From joe@test', '', 'body']
+    parts = []
+    for i in xrange(n):
+        parts.append(sep)
+        parts.extend(rnd.choice(lines) + '\n' for j in xrange(rnd.randint(0, 6)))
+        if rnd.random() < 0.8:
+            parts.append(sep)
+    data = ''.join(parts)
+    if data and rnd.random() < 0.3:
+        data = data[:-1]
+    return data
+
+class BoundariesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='muttlearn-test')
+        self.path = os.path.join(self.dir, 'mailbox')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def check(self, data, type, name):
+        f = open(self.path, 'wb')
+        f.write(data)
+        f.close()
+        if type == 'mbox':
+            expected = mailbox.mbox(self.path, create=False)
+        else:
+            expected = mailbox.MMDF(self.path, create=False)
+        try:
+            keys = sorted(expected.keys())
+            messages = [expected.get_file(key).read() for key in keys]
+        finally:
+            expected.close()
+        mb = mboxfile.MboxFile(self.path, type)
+        self.assertEqual(len(mb), len(messages), name)
+        self.assertEqual(list(mb.iterkeys()), range(len(messages)), name)
+        for key, message in enumerate(messages):
+            self.assertEqual(mb.get_string(key), message, '%s: message %d' % (name, key))
+
+    def test_mbox(self):
+        for name, data in sorted(mbox_cases.iteritems()):
+            self.check(data, 'mbox', name)
+
+    def test_mmdf(self):
+        for name, data in sorted(mmdf_cases.iteritems()):
+            self.check(data, 'MMDF', name)
+
+    def test_random_mbox(self):
+        rnd = random.Random(1)
+        for i in xrange(300):
+            data = random_mbox(rnd, rnd.randint(0, 8))
+            self.check(data, 'mbox', repr(data))
+
+    def test_random_mmdf(self):
+        rnd = random.Random(2)
+        for i in xrange(300):
+            data = random_mmdf(rnd, rnd.randint(0, 8))
+            self.check(data, 'MMDF', repr(data))
+
+    def test_newline_after_stop(self):
+        # the first message is empty, the next newline belongs to the
+        # second one
+        data = sep + sep + 'two\n' + sep
+        self.check(data, 'MMDF', 'newline after stop')
+        mb = mboxfile.MboxFile(self.path, 'MMDF')
+        self.assertEqual(str(mb.get_buffer(0)), '')
+        self.assertEqual(str(mb.get_buffer(1)), '')
+
+    def test_restore_unchanged(self):
+        data = mbox_cases['two']
+        f = open(self.path, 'wb')
+        f.write(data)
+        f.close()
+        os.utime(self.path, (1000000000, 1000000000))
+        mb = mboxfile.MboxFile(self.path)
+        len(mb)
+        state = mb.get_state()
+        mb = mboxfile.MboxFile(self.path)
+        mb.restore(state)
+        self.assertEqual(mb.n_unchanged, 2)
+        self.assertEqual(mb.get_string(1), header + 'two\n')
+
+    def test_restore_rewritten_recently(self):
+        data = mbox_cases['two']
+        f = open(self.path, 'wb')
+        f.write(data)
+        f.close()
+        mtime = int(time.time())
+        os.utime(self.path, (mtime, mtime))
+        mb = mboxfile.MboxFile(self.path)
+        len(mb)
+        state = mb.get_state()
+        # rewritten in place within the mtime resolution
+        f = open(self.path, 'wb')
+        f.write(data.replace('two', 'TWO'))
+        f.close()
+        os.utime(self.path, (mtime, mtime))
+        mb = mboxfile.MboxFile(self.path)
+        mb.restore(state)
+        self.assertEqual(mb.n_unchanged, 0)
+        self.assertEqual(mb.get_string(1), header + 'TWO\n')
+
+    def test_restore_appended(self):
+        data = mbox_cases['two']
+        f = open(self.path, 'wb')
+        f.write(data)
+        f.close()
+        mb = mboxfile.MboxFile(self.path)
+        len(mb)
+        state = mb.get_state()
+        f = open(self.path, 'ab')
+        f.write('\n' + mbox_cases['From inside body'])
+        f.close()
+        mb = mboxfile.MboxFile(self.path)
+        mb.restore(state)
+        self.assertEqual(mb.n_unchanged, 1)
+        scanned = mboxfile.MboxFile(self.path)
+        self.assertEqual([mb.get_string(key) for key in mb.iterkeys()],
+                         [scanned.get_string(key) for key in scanned.iterkeys()])
+        self.assertEqual(len(mb), 4)
+
+if __name__ == '__main__':
+    unittest.main()
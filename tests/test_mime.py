@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Test that mime finds the same text part as the email package.
+
+Run from the top directory: python -m unittest discover -s tests
+
+"""
+
+import random
+import base64
+import quopri
+import unittest
+import email
+
+from muttlearn import mime
+
+def old_text_part(s):
+    """Return the text/plain part of message s like muttlearn did before
+    the mime module, by parsing the whole message.
+
+    """
+    msg = email.message_from_string(s)
+    if msg.is_multipart():
+        for part in msg.walk():
+            if part.get_content_type() == 'text/plain':
+                return part
+        return None
+    if msg.get_content_type() != 'text/plain':
+        return None
+    return msg
+
+def text_part(s):
+    msg, body = mime.parse_header(s)
+    return mime.find_text_part(msg, s, body)
+
+header = 'From: joe@test\nTo: anna@test\nSubject: test\n'
+
+def leaf(ctype, body, encoding=None, extra=''):
+    h = 'Content-Type: %s\n' % ctype
+    if encoding:
+        h += 'Content-Transfer-Encoding: %s\n' % encoding
+    return h + extra + '\n' + body
+
+def multipart(subtype, parts, boundary='b0', preamble='', epilogue='', close=True):
+    s = 'Content-Type: multipart/%s; boundary="%s"\n\n%s' % (subtype, boundary, preamble)
+    for p in parts:
+        s += '--%s\n%s\n' % (boundary, p)
+    if close:
+        s += '--%s--\n%s' % (boundary, epilogue)
+    return s
+
+cases = {
+    'plain': header + '\nHello Anna\n',
+    'no body': header,
+    'empty body': header + '\n',
+    'charset': header + leaf('text/plain; charset=iso-8859-1', 'Gr\xfc\xdfe\n'),
+    'quoted-printable': header + leaf('text/plain; charset=utf-8', 'Gr=C3=BC=C3=9Fe=\n Joe\n',
+                                      'quoted-printable'),
+    'base64': header + leaf('text/plain', base64.encodestring('Hello Anna\n'), 'base64'),
+    'html only': header + leaf('text/html', '<p>Hello</p>\n'),
+    'no header end': header.rstrip('\n'),
+    'body without empty line': header + 'not a header line\nHello\n',
+    'mixed': header + multipart('mixed', [
+        leaf('text/plain', 'Hello Anna\n'),
+        leaf('application/octet-stream', base64.encodestring('\0' * 100), 'base64')]),
+    'attachment first': header + multipart('mixed', [
+        leaf('application/pdf', base64.encodestring('%PDF'), 'base64'),
+        leaf('text/plain', 'Hello Anna\n')]),
+    'alternative': header + multipart('alternative', [
+        leaf('text/html', '<p>Hello</p>\n'),
+        leaf('text/plain', 'Hello\n\n')], preamble='This is MIME.\n', epilogue='bye\n'),
+    'nested': header + multipart('mixed', [
+        multipart('alternative', [
+            leaf('text/html', '<p>Hello</p>\n'),
+            leaf('text/plain', 'Hello nested\n')], boundary='b1'),
+        leaf('text/plain', 'second\n')]),
+    'no text part': header + multipart('mixed', [
+        leaf('image/png', base64.encodestring('PNG'), 'base64'),
+        multipart('alternative', [leaf('text/html', '<p>x</p>\n')], boundary='b1')]),
+    'forwarded': header + multipart('mixed', [
+        leaf('message/rfc822', header + '\nforwarded text\n')]),
+    'message': header + leaf('message/rfc822', header + '\nwrapped text\n'),
+    'digest': header + multipart('digest', [
+        '\n' + header + '\ndigested text\n']),
+    'missing close boundary': header + multipart('mixed', [
+        leaf('text/plain', 'unclosed\n')], close=False),
+    'repeated boundary': header + multipart('mixed', [
+        '', leaf('text/plain', 'after empty part\n')]),
+    'boundary with spaces': header + multipart('mixed', [
+        leaf('text/plain', 'text\n')]).replace('--b0\n', '--b0  \n'),
+    'boundary in text': header + multipart('mixed', [
+        leaf('text/plain', '--b0x is not a boundary\n-- b0\n')]),
+    'no boundary': header + 'Content-Type: multipart/mixed\n\n--b0\n\ntext\n--b0--\n',
+    'CRLF': (header + multipart('mixed', [
+        leaf('text/plain', 'Hello CRLF\n')])).replace('\n', '\r\n'),
+    'no line break at end': (header + multipart('mixed', [
+        leaf('text/plain', 'last')])).rstrip('\n'),
+    'report': header + multipart('report; report-type=delivery-status', [
+        leaf('message/delivery-status', 'Reporting-MTA: dns; test\n\nStatus: 5.0.0\n'),
+        leaf('text/plain', 'delivery failed\n')]),
+    'report with type': header + multipart('report', [
+        leaf('message/delivery-status', 'Content-Type: text/html\n\nStatus: 5.0.0\n'),
+        leaf('text/plain', 'delivery failed\n')]),
+    'empty report': header + leaf('message/delivery-status', ''),
+    'signed': header + multipart('signed', [
+        leaf('text/plain; charset=us-ascii', 'signed text\n'),
+        leaf('application/pgp-signature', '-----BEGIN PGP SIGNATURE-----\n')]),
+}
+
+def random_body(rnd):
+    lines = ['text', '', '--b0', '--b1--', '--b2 ', 'From x', '> quoted', '=3D', 'Content-Type: text/html']
+    return ''.join(rnd.choice(lines) + '\n' for i in xrange(rnd.randint(0, 4)))
+
+def random_part(rnd, depth=0):
+    """Return a random MIME part, nested up to three levels."""
+    kind = rnd.random()
+    if depth < 3 and kind < 0.3:
+        subtype = rnd.choice(['mixed', 'alternative', 'digest', 'related'])
+        parts = [random_part(rnd, depth + 1) for i in xrange(rnd.randint(0, 3))]
+        if subtype == 'digest':
+            parts = [p if rnd.random() < 0.5 else '\n' + header + '\n' + random_body(rnd)
+                     for p in parts]
+        return multipart(subtype, parts, 'b%d' % depth,
+                         preamble=random_body(rnd) if rnd.random() < 0.3 else '',
+                         epilogue=random_body(rnd) if rnd.random() < 0.3 else '',
+                         close=rnd.random() < 0.9)
+    if depth < 3 and kind < 0.4:
+        return leaf('message/rfc822', header + random_part(rnd, depth + 1))
+    ctype = rnd.choice(['text/plain', 'text/plain; charset=utf-8', 'text/html',
+                        'application/octet-stream', 'image/png', 'message/delivery-status'])
+    body = random_body(rnd)
+    encoding = rnd.choice([None, '7bit', 'base64', 'quoted-printable'])
+    if encoding == 'base64':
+        body = base64.encodestring(body)
+    elif encoding == 'quoted-printable':
+        body = quopri.encodestring(body)
+    return leaf(ctype, body, encoding)
+
+class TextPartTest(unittest.TestCase):
+
+    def check(self, s, name):
+        expected = old_text_part(s)
+        part = text_part(s)
+        if expected is None:
+            self.assertEqual(part, None, name)
+            return
+        self.assertNotEqual(part, None, name)
+        self.assertEqual(part.get_content_type(), expected.get_content_type(), name)
+        self.assertEqual(part.get_content_charset(''), expected.get_content_charset(''), name)
+        self.assertEqual(part.get_payload(decode=True), expected.get_payload(decode=True), name)
+
+    def test_cases(self):
+        for name, s in sorted(cases.iteritems()):
+            self.check(s, name)
+
+    def test_buffer(self):
+        s = 'garbage' + cases['nested'] + 'garbage'
+        buf = buffer(s)
+        msg, body = mime.parse_header(buf, 7, len(s) - 7)
+        part = mime.find_text_part(msg, buf, body, len(s) - 7)
+        self.assertEqual(part.get_payload(), old_text_part(cases['nested']).get_payload())
+
+    def test_header_end(self):
+        self.assertEqual(mime.header_end(cases['plain']), len(header))
+        self.assertEqual(mime.header_end(cases['no header end']), len(cases['no header end']))
+
+    def test_random(self):
+        rnd = random.Random(1)
+        for i in xrange(2000):
+            s = header + random_part(rnd)
+            if rnd.random() < 0.1:
+                s = s.replace('\n', '\r\n')
+            self.check(s, repr(s))
+
+if __name__ == '__main__':
+    unittest.main()
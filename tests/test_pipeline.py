@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2010-2017 Johannes Weißl
+# License GPLv3+:
+# GNU GPL version 3 or later <http://gnu.org/licenses/gpl.html>.
+# This is free software: you are free to change and redistribute it.
+# There is NO WARRANTY, to the extent permitted by law
+
+"""Test that a threaded Pipeline returns the same items as the stages
+chained in one thread, that an exception raised in a stage reaches the
+caller, and that a pipeline can be stopped before it is consumed.
+
+Run from the top directory: python -m unittest discover -s tests
+
+"""
+
+import time
+import random
+import unittest
+
+from muttlearn import pipeline
+
+names = ['read', 'lookup', 'analyze', 'aggregate']
+
+def double(items):
+    for x in items:
+        yield 2 * x
+
+def skip_odd_tenths(items):
+    for x in items:
+        if (x // 10) % 2 == 0:
+            yield x + 1
+
+def slow(items):
+    for x in items:
+        if x % 97 == 0:
+            time.sleep(0.001)
+        yield x
+
+class Failure(Exception):
+    pass
+
+def fail_at(n):
+    def func(items):
+        for x in items:
+            if x == n:
+                raise Failure(x)
+            yield x
+    return func
+
+class PipelineTest(unittest.TestCase):
+
+    def results(self, source, funcs, **kwargs):
+        engine = pipeline.Pipeline(names, **kwargs)
+        try:
+            return list(engine.run(source, *funcs))
+        finally:
+            engine.stop()
+
+    def test_serial(self):
+        rnd = random.Random(1)
+        source = [rnd.randint(0, 1000) for i in xrange(300)]
+        for funcs in [(double, skip_odd_tenths), (slow, double), (skip_odd_tenths, slow)]:
+            expected = self.results(source, funcs, threaded=False)
+            for maxsize, batch_size in [(64, 16), (1, 1), (4, 3), (1000, 100)]:
+                self.assertEqual(self.results(iter(source), funcs, maxsize=maxsize,
+                                              batch_size=batch_size), expected)
+        self.assertEqual(self.results([], (double, slow)), [])
+
+    def test_generator_source(self):
+        source = (x for x in xrange(100) if x % 3)
+        self.assertEqual(self.results(source, (double, double)),
+                         [4 * x for x in xrange(100) if x % 3])
+
+    def test_error(self):
+        for funcs, value in [((fail_at(10), double), 10), ((double, fail_at(20)), 20)]:
+            engine = pipeline.Pipeline(names, maxsize=4, batch_size=2)
+            try:
+                results = []
+                try:
+                    for x in engine.run(xrange(100), *funcs):
+                        results.append(x)
+                except Failure, e:
+                    self.assertEqual(e.args, (value,))
+                else:
+                    self.fail('exception not raised')
+                self.assertEqual(results, [2 * x for x in xrange(10)])
+            finally:
+                engine.stop()
+
+    def test_error_in_source(self):
+        def source():
+            yield 1
+            raise Failure('source')
+        self.assertRaises(Failure, self.results, source(), (double, double))
+
+    def test_stop(self):
+        # stop while the stages are still filling their queues
+        for maxsize, batch_size in [(1, 1), (4, 2), (64, 16)]:
+            engine = pipeline.Pipeline(names, maxsize=maxsize, batch_size=batch_size)
+            results = engine.run(xrange(100000), double, slow)
+            self.assertEqual([results.next() for i in xrange(5)], [0, 2, 4, 6, 8])
+            engine.stop()
+            self.assertEqual(engine._threads, [])
+        # and a pipeline can run again afterwards
+        self.assertEqual(list(engine.run(xrange(5), double, double)), [0, 4, 8, 12, 16])
+        engine.stop()
+
+if __name__ == '__main__':
+    unittest.main()